@@ -0,0 +1,91 @@
+import json
+import threading
+import subprocess
+from log import logger
+import subtitles
+
+SAMPLE_RATE = 16000
+CHUNK_SIZE = 8000
+
+_recognizer = None
+_recognizer_lock = threading.Lock()
+
+
+class Recognizer:
+    """
+    Speech recognition service keeping the Vosk model loaded between jobs.
+
+    Audio is decoded by ffmpeg and fed to Vosk in fixed size chunks as it is
+    produced, and subtitle cues are emitted as soon as a phrase is recognized.
+    Vosk is only imported when the first recognizer is created.
+    """
+
+    def __init__(self, lang="en-us"):
+        from vosk import Model, KaldiRecognizer, SetLogLevel
+
+        SetLogLevel(-1)
+        self._recognizer_class = KaldiRecognizer
+        logger.info(f'Loading Vosk {lang} model')
+        self.model = Model(lang=lang)
+
+    def _cues(self, result):
+        words = json.loads(result).get('result', [])
+        for i in range(0, len(words), subtitles.WORDS_PER_CUE):
+            line = words[i:i + subtitles.WORDS_PER_CUE]
+            yield line[0]['start'], line[-1]['end'], ' '.join(word['word'] for word in line)
+
+    def transcribe(self, audio_file):
+        """
+        Recognize the speech of an audio file.
+
+        Args:
+            audio_file (str): Path to the audio file.
+
+        Yields:
+            tuple: Subtitle cues as (start, end, text), times in seconds, as soon as they are recognized.
+        """
+        rec = self._recognizer_class(self.model, SAMPLE_RATE)
+        rec.SetWords(True)
+        with subprocess.Popen(["ffmpeg", "-loglevel", "quiet", "-i", audio_file,
+                               "-ar", str(SAMPLE_RATE), "-ac", "1", "-f", "s16le", "-"],
+                              stdout=subprocess.PIPE) as process:
+            while True:
+                data = process.stdout.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if rec.AcceptWaveform(data):
+                    yield from self._cues(rec.Result())
+        yield from self._cues(rec.FinalResult())
+
+    def generate_srt(self, audio_file, output_file):
+        """
+        Generate SRT subtitles from an audio file, writing every cue as soon as it is recognized.
+
+        Args:
+            audio_file (str): Path to the audio file.
+            output_file (str): Output file name for the generated srt file
+
+        Returns:
+            str: Path to the srt file.
+        """
+        logger.info('Generating srt subtitles files')
+        with open(output_file, "w") as file:
+            for number, cue in enumerate(self.transcribe(audio_file), start=1):
+                file.write(subtitles.format_cue(number, cue))
+                file.flush()
+        logger.info('SRT file created successfully')
+        return output_file
+
+
+def get_recognizer():
+    """
+    Get the process wide recognizer, loading the model on first use.
+
+    Returns:
+        Recognizer: The shared recognizer.
+    """
+    global _recognizer
+    with _recognizer_lock:
+        if _recognizer is None:
+            _recognizer = Recognizer()
+        return _recognizer
@@ -0,0 +1,210 @@
+import os
+import csv
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from log import logger
+import utils
+import short
+import effects
+from profiles import PROFILES, RENDER_PROFILE, get_profile
+from workspace import Workspace, TMP_FOLDER, WORKSPACE_RAM
+
+
+def read_manifest(manifest_path):
+    """
+    Read the jobs of a batch manifest.
+
+    The manifest is either a JSONL file with one object per line or a CSV file with
+    a header row. Each job has a 'text' (or an 'input' text file), a 'topic', optional
+    comma separated 'effects', an optional render 'profile' and an 'output' path.
+
+    Args:
+        manifest_path (str): Path of the .jsonl or .csv manifest.
+
+    Raises:
+        ValueError: If a job is missing required fields or uses an unknown effect or profile.
+
+    Returns:
+        list: The jobs as dicts with 'text', 'topic', 'fx', 'profile' and 'output' keys.
+    """
+    with open(manifest_path, 'r', newline='') as file:
+        if manifest_path.endswith('.csv'):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    return [parse_job(row, f'Job {number} of {manifest_path}') for number, row in enumerate(rows, start=1)]
+
+def parse_job(row, name='Job'):
+    """
+    Validate a job and normalize its fields.
+
+    Args:
+        row (dict): The job with 'text' (or an 'input' text file), 'topic', 'output', and optional
+            'effects' (a list or a comma separated string) and 'profile'.
+        name (str): Name of the job in error messages.
+
+    Raises:
+        ValueError: If the job is missing required fields, has fields of the wrong type or uses an
+            unknown effect or profile.
+
+    Returns:
+        dict: The job with 'text', 'topic', 'fx', 'profile' and 'output' keys.
+    """
+    for field in ('text', 'input', 'topic', 'output', 'profile'):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            raise ValueError(f'{name} has a {field} that is not a string')
+    fx = row.get('effects') or []
+    if not isinstance(fx, (str, list)) or not all(isinstance(effect, str) for effect in fx):
+        raise ValueError(f'{name} needs effects as a list or a comma separated string of names')
+
+    text = row.get('text')
+    if not text and row.get('input'):
+        with open(row['input'], 'r') as input_file:
+            text = input_file.read()
+    if not text or not row.get('topic') or not row.get('output'):
+        raise ValueError(f'{name} needs text (or input), topic and output')
+
+    if isinstance(fx, str):
+        fx = [effect.strip() for effect in fx.split(',') if effect.strip()]
+    effects.get_effects(fx)
+    profile = row.get('profile') or None
+    if profile:
+        get_profile(profile)
+    return {'text': text, 'topic': row['topic'], 'fx': fx, 'profile': profile, 'output': row['output']}
+
+class BatchRunner:
+    """
+    Run many shorts in one process as a staged pipeline.
+
+    Every stage has its own bounded pool, so speech synthesis, footage downloads,
+    subtitle recognition and rendering of different jobs run at the same time while
+    the models stay loaded between jobs. Each job works in its own workspace.
+    """
+
+    def __init__(self, tts_workers=1, download_workers=2, subtitle_workers=1, render_workers=2,
+                 tmp_folder=TMP_FOLDER, ram=WORKSPACE_RAM, report_folder=None, profile=RENDER_PROFILE):
+        self.tts_pool = ThreadPoolExecutor(max_workers=tts_workers, thread_name_prefix='tts')
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='download')
+        self.subtitle_pool = ThreadPoolExecutor(max_workers=subtitle_workers, thread_name_prefix='subtitle')
+        self.render_pool = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix='render')
+        self.executors = {'tts': self.tts_pool, 'footage': self.download_pool, 'srt': self.subtitle_pool,
+                          'merge': self.render_pool, 'render': self.render_pool}
+        # enough jobs in flight to keep every pool busy, without a workspace per job of the manifest
+        self.job_slots = tts_workers + download_workers + subtitle_workers + render_workers
+        self.tmp_folder = tmp_folder
+        self.ram = ram
+        self.report_folder = report_folder
+        self.profile = get_profile(profile)
+
+    def run_job(self, job, metrics=None):
+        """
+        Run a single job through every stage.
+
+        Args:
+            job (dict): The job with 'text', 'topic', 'fx', 'output' and an optional 'profile' keys.
+            metrics (JobMetrics, optional): Measurements of the job, a new one is used when omitted.
+
+        Returns:
+            str: Path of the rendered video.
+        """
+        workspace = Workspace(tmp_folder=self.tmp_folder, ram=self.ram, metrics=metrics)
+        try:
+            # footage and subtitles only depend on the audio, so the pipeline runs them at the same time
+            pipeline = short.build_pipeline(job['text'], job['topic'], job['fx'],
+                                            get_profile(job.get('profile') or self.profile), workspace,
+                                            executors=self.executors)
+            outputs = pipeline.run()
+            short.save_output(outputs['render'][0], job['output'])
+            return job['output']
+        finally:
+            if self.report_folder:
+                os.makedirs(self.report_folder, exist_ok=True)
+                workspace.metrics.write_report(
+                    os.path.join(self.report_folder, os.path.basename(job['output']) + '.json'))
+            utils.clean_up(workspace)
+
+    def run(self, jobs):
+        """
+        Run every job, keeping all the stages busy.
+
+        At most job_slots jobs are started at the same time, the others wait for a slot.
+
+        Args:
+            jobs (list): The jobs to run.
+
+        Returns:
+            list: One (job, output path or None, error or None) tuple per job, in manifest order.
+        """
+        results = []
+        slots = max(1, min(len(jobs), self.job_slots))
+        with ThreadPoolExecutor(max_workers=slots, thread_name_prefix='job') as drivers:
+            futures = [drivers.submit(self.run_job, job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                try:
+                    results.append((job, future.result(), None))
+                except Exception as e:
+                    logger.error(f'Job for {job["output"]} failed: {e}')
+                    results.append((job, None, e))
+        return results
+
+    def shutdown(self):
+        """
+        Stop the stage pools.
+
+        Returns:
+            None
+        """
+        for pool in (self.tts_pool, self.download_pool, self.subtitle_pool, self.render_pool):
+            pool.shutdown()
+
+
+def main(manifest, tts_workers=1, download_workers=2, subtitle_workers=1, render_workers=2, report_folder=None,
+         profile=RENDER_PROFILE):
+    """
+    Generate every short listed in a manifest.
+
+    Parameters:
+    - manifest (str): Path of the .jsonl or .csv manifest.
+    - tts_workers (int): Number of jobs synthesizing speech at the same time.
+    - download_workers (int): Number of jobs downloading footage at the same time.
+    - subtitle_workers (int): Number of jobs generating subtitles at the same time.
+    - render_workers (int): Number of jobs rendering at the same time.
+    - report_folder (str): Folder receiving a JSON report with the stage measurements of every job.
+    - profile (str): Render profile of the jobs that do not set one.
+
+    Returns:
+    list: The results of BatchRunner.run.
+    """
+    jobs = read_manifest(manifest)
+    runner = BatchRunner(tts_workers=tts_workers, download_workers=download_workers,
+                         subtitle_workers=subtitle_workers, render_workers=render_workers,
+                         report_folder=report_folder, profile=profile)
+    try:
+        results = runner.run(jobs)
+    finally:
+        runner.shutdown()
+
+    failed = sum(1 for _, _, error in results if error)
+    logger.info(f'Batch finished: {len(results) - failed} succeeded, {failed} failed')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate many short videos from a manifest.")
+    parser.add_argument("-m", "--manifest", dest="manifest", required=True, help="JSONL or CSV manifest of jobs")
+    parser.add_argument("--tts-workers", dest="tts_workers", type=int, default=1, help="Concurrent speech synthesis jobs")
+    parser.add_argument("--download-workers", dest="download_workers", type=int, default=2, help="Concurrent footage download jobs")
+    parser.add_argument("--subtitle-workers", dest="subtitle_workers", type=int, default=1, help="Concurrent subtitle jobs")
+    parser.add_argument("--render-workers", dest="render_workers", type=int, default=2, help="Concurrent render jobs")
+    parser.add_argument("--profile", dest="profile", choices=list(PROFILES), default=RENDER_PROFILE,
+                        help="Render profile of the jobs that do not set one")
+    parser.add_argument("--report-folder", dest="report_folder", help="Folder for the per job JSON stage reports")
+    args = parser.parse_args()
+
+    results = main(args.manifest, tts_workers=args.tts_workers, download_workers=args.download_workers,
+                   subtitle_workers=args.subtitle_workers, render_workers=args.render_workers,
+                   report_folder=args.report_folder, profile=args.profile)
+    if any(error for _, _, error in results):
+        raise SystemExit(1)
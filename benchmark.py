@@ -0,0 +1,443 @@
+import os
+import re
+import json
+import time
+import wave
+import random
+import sys
+import shutil
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from log import logger
+import subtitles
+
+WORDS = ('mountain river forest morning light travels slowly across the valley while clouds gather above '
+         'quiet villages and old roads lead towards the sea where waves break on the rocks').split()
+WORDS_PER_SENTENCE = 12
+WORDS_PER_SECOND = 2.5
+SAMPLE_RATE = 22050
+CLIP_FPS = 25
+CLIP_WIDTHS = {1920: 1080, 1280: 720}
+FIRST_ID = 1000
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+# Modules that have to import fast, and the ML backends they must not pull in
+FAST_MODULES = ('short', 'batch', 'pexels', 'utils', 'render', 'effects')
+HEAVY_MODULES = ('torch', 'TTS', 'vosk')
+IMPORT_BUDGET = float(os.environ.get('IMPORT_BUDGET', '0.5'))
+
+
+class ClipLibrary:
+    """
+    Synthetic stand-in for the Pexels video library.
+
+    Durations are drawn from a seeded generator so every run sees the same library,
+    and the clips are rendered with ffmpeg testsrc2 the first time they are requested.
+    """
+
+    def __init__(self, folder, count=160, seed=0):
+        """
+        Args:
+            folder (str): Folder holding the rendered clips.
+            count (int): Number of videos in the library.
+            seed (int): Seed of the clip durations.
+        """
+        self.folder = folder
+        rng = random.Random(seed)
+        self.durations = {FIRST_ID + i: rng.randint(4, 25) for i in range(count)}
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def video(self, media_id, base_url):
+        """
+        Get the metadata of a video as returned by the Pexels API.
+
+        Args:
+            media_id (int): The ID of the video.
+            base_url (str): URL of the server, used for the file links.
+
+        Returns:
+            dict: The video metadata, or None if the video does not exist.
+        """
+        if media_id not in self.durations:
+            return None
+        return {
+            'id': media_id,
+            'width': 1920,
+            'height': 1080,
+            'duration': self.durations[media_id],
+            'video_files': [{'width': width, 'height': height, 'fps': CLIP_FPS,
+                             'link': f'{base_url}/clips/{media_id}_{width}.mp4'}
+                            for width, height in CLIP_WIDTHS.items()],
+        }
+
+    def search(self, page, per_page, base_url):
+        """
+        Get a page of search results, every query returns the whole library.
+
+        Args:
+            page (int): Page number, starting at 1.
+            per_page (int): Number of videos per page.
+            base_url (str): URL of the server, used for the file links.
+
+        Returns:
+            list: The video metadata of the page.
+        """
+        ids = sorted(self.durations)[(page - 1) * per_page:page * per_page]
+        return [self.video(media_id, base_url) for media_id in ids]
+
+    def clip(self, media_id, width):
+        """
+        Get the path of a clip, rendering it on first use.
+
+        Args:
+            media_id (int): The ID of the video.
+            width (int): Width of the file, 1920 or 1280.
+
+        Raises:
+            ValueError: If ffmpeg fails to render the clip.
+
+        Returns:
+            str: Path of the clip.
+        """
+        clip_file = os.path.join(self.folder, f'{media_id}_{width}.mp4')
+        with self._lock:
+            lock = self._locks.setdefault(clip_file, threading.Lock())
+        with lock:
+            if os.path.exists(clip_file):
+                return clip_file
+            tmp_file = clip_file + '.tmp.mp4'
+            size = f'{width}x{CLIP_WIDTHS[width]}'
+            process = subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                                      '-i', f'testsrc2=size={size}:rate={CLIP_FPS}:duration={self.durations[media_id]}',
+                                      '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                                      '-movflags', '+faststart', tmp_file], stderr=subprocess.PIPE, text=True)
+            if process.returncode != 0:
+                raise ValueError(f'Unable to render synthetic clip {media_id}: {process.stderr}')
+            os.replace(tmp_file, clip_file)
+            return clip_file
+
+
+class _PexelsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            else:
+                start = max(0, size - int(match.group(2)))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = file.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def do_GET(self):
+        library = self.server.library
+        base_url = self.server.base_url
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        try:
+            if url.path == '/v1/videos/search':
+                query = parse_qs(url.query)
+                page = int(query.get('page', ['1'])[0])
+                per_page = int(query.get('per_page', ['15'])[0])
+                self._send_json({'page': page, 'per_page': per_page,
+                                 'videos': library.search(page, per_page, base_url)})
+            elif parts[:2] == ['videos', 'videos'] and len(parts) == 3:
+                video = library.video(int(parts[2]), base_url)
+                if video is None:
+                    self._send_json({'error': 'Not Found'}, status=404)
+                else:
+                    self._send_json(video)
+            elif parts[0] == 'clips' and len(parts) == 2:
+                media_id, width = os.path.splitext(parts[1])[0].split('_')
+                self._send_file(library.clip(int(media_id), int(width)))
+            else:
+                self._send_json({'error': 'Not Found'}, status=404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve_pexels(library, host='127.0.0.1', port=0):
+    """
+    Start a local server mimicking the Pexels video API in a background thread.
+
+    It answers /v1/videos/search, /videos/videos/{id} and serves the clip files,
+    with range requests, from the library.
+
+    Args:
+        library (ClipLibrary): The synthetic library.
+        host (str): Address to listen on.
+        port (int): Port to listen on, a free one when 0.
+
+    Returns:
+        ThreadingHTTPServer: The running server, with its URL in base_url.
+    """
+    server = ThreadingHTTPServer((host, port), _PexelsHandler)
+    server.daemon_threads = True
+    server.library = library
+    server.base_url = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Pexels stand-in listening on {server.base_url}')
+    return server
+
+
+class StubSpeechEngine:
+    """
+    Speech engine writing a tone lasting as long as the text would take to read.
+
+    It replaces tts.SpeechEngine so the benchmark never loads the VITS model.
+    """
+
+    model_name = 'benchmark-stub'
+
+    def synthesize(self, txt, output_file, speaker=None):
+        frames = int(len(txt.split()) / WORDS_PER_SECOND * SAMPLE_RATE)
+        # one period of a quiet 220.5 Hz square wave, 16 bit little endian
+        period = (b'\x00\x08' * 50) + (b'\x00\xf8' * 50)
+        with wave.open(output_file, 'wb') as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(SAMPLE_RATE)
+            output.writeframes((period * (frames // 100 + 1))[:frames * 2])
+        return output_file
+
+    def synthesize_batch(self, jobs):
+        return [self.synthesize(job['text'], job['output_file']) for job in jobs]
+
+
+class StubRecognizer:
+    """
+    Recognizer writing a single cue over the whole audio.
+
+    It replaces asr.Recognizer so the benchmark never loads the Vosk model.
+    """
+
+    def generate_srt(self, audio_file, output_file):
+        with wave.open(audio_file, 'rb') as audio:
+            duration = audio.getnframes() / audio.getframerate()
+        return subtitles.write_srt([(0, duration, 'benchmark')], output_file)
+
+
+def check_imports(modules=FAST_MODULES, budget=IMPORT_BUDGET):
+    """
+    Measure the import time of modules, each one in a fresh interpreter.
+
+    Args:
+        modules (tuple): Names of the modules to import.
+        budget (float): Maximum import time of a module, in seconds.
+
+    Returns:
+        list: One dict per module with its import 'seconds', the 'heavy' backends it loaded
+              and whether it stayed 'within_budget'.
+    """
+    code = ('import sys, time; started = time.perf_counter(); import {module}; '
+            'print(time.perf_counter() - started, *[name for name in {heavy} if name in sys.modules])')
+    results = []
+    for module in modules:
+        process = subprocess.run([sys.executable, '-c', code.format(module=module, heavy=HEAVY_MODULES)],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            raise ValueError(f'Unable to import {module}: {process.stderr}')
+        seconds, *heavy = process.stdout.split()
+        results.append({'module': module, 'seconds': round(float(seconds), 3), 'heavy': heavy,
+                        'within_budget': float(seconds) <= budget and not heavy})
+    return results
+
+def make_script(words, seed=0):
+    """
+    Build a deterministic script.
+
+    Args:
+        words (int): Number of words of the script.
+        seed (int): Seed of the word choice.
+
+    Returns:
+        str: The script, in sentences of WORDS_PER_SENTENCE words.
+    """
+    rng = random.Random(seed)
+    chosen = [rng.choice(WORDS) for _ in range(words)]
+    sentences = [' '.join(chosen[i:i + WORDS_PER_SENTENCE]).capitalize() + '.'
+                 for i in range(0, words, WORDS_PER_SENTENCE)]
+    return ' '.join(sentences)
+
+def configure(folder, api_url):
+    """
+    Point every cache and the Pexels client at the benchmark folder and server.
+
+    The pipeline modules read these settings when they are imported, so this has to
+    run before the first import of short, and the stub backends are installed right after.
+
+    Args:
+        folder (str): Benchmark folder.
+        api_url (str): URL of the Pexels stand-in.
+
+    Returns:
+        module: The short module, ready to run.
+    """
+    cache_folder = os.path.join(folder, 'cache')
+    os.environ.update({
+        'PEXELS_API_URL': api_url,
+        'API_KEY': 'benchmark',
+        'TMP_FOLDER': os.path.join(folder, 'tmp/'),
+        'TTS_CACHE_FOLDER': os.path.join(cache_folder, 'tts/'),
+        'TTS_SOCKET': '',
+        'TTS_WORKERS': '1',
+        'CLIP_CACHE_FOLDER': os.path.join(cache_folder, 'clips/'),
+        'GRAIN_CACHE_FOLDER': os.path.join(cache_folder, 'grain/'),
+        'METADATA_DB': os.path.join(cache_folder, 'pexels.sqlite3'),
+        'PIPELINE_CACHE_FOLDER': os.path.join(cache_folder, 'stages/'),
+        'PROBE_DB': os.path.join(cache_folder, 'probe.sqlite3'),
+    })
+    import short
+    import tts
+    import asr
+    tts._engine = StubSpeechEngine()
+    asr._recognizer = StubRecognizer()
+    return short
+
+def run_benchmark(lengths, fx_sets, repeat=1, seed=0, folder='bench/', clips=160, warm=False, profile=None):
+    """
+    Run the whole pipeline offline for every script length and effect combination.
+
+    Args:
+        lengths (list): Script lengths in words.
+        fx_sets (list): Effect combinations, each one a list of effect names.
+        repeat (int): Number of runs of every scenario.
+        seed (int): Seed of the library, the scripts and every random choice of the pipeline.
+        folder (str): Benchmark folder holding the library, caches and outputs.
+        clips (int): Number of videos in the synthetic library.
+        warm (bool): Keep the caches between runs instead of starting every run cold.
+        profile (str, optional): Render profile. Defaults to RENDER_PROFILE.
+
+    Returns:
+        list: One dict per run with the scenario, the end to end time and the time of every stage.
+    """
+    library = ClipLibrary(os.path.join(folder, 'library'), count=clips, seed=seed)
+    server = serve_pexels(library)
+    short = configure(folder, server.base_url)
+    cache_folder = os.path.join(folder, 'cache')
+    output_folder = os.path.join(folder, 'out')
+    os.makedirs(output_folder, exist_ok=True)
+
+    results = []
+    try:
+        for words in lengths:
+            script = make_script(words, seed=seed)
+            for fx in fx_sets:
+                name = '+'.join(fx) or 'none'
+                for run in range(repeat):
+                    if not warm:
+                        shutil.rmtree(cache_folder, ignore_errors=True)
+                    random.seed(seed)
+                    output_file = os.path.join(output_folder, f'{words}_{name}_{run}.mp4')
+                    report_file = output_file + '.json'
+
+                    started = time.perf_counter()
+                    short.main(input_text=script, topic='benchmark', fx=fx, output_file=output_file,
+                               report=report_file, profile=profile)
+                    total = time.perf_counter() - started
+
+                    with open(report_file, 'r') as file:
+                        report = json.load(file)
+                    results.append({
+                        'words': words,
+                        'fx': name,
+                        'run': run,
+                        'end_to_end_seconds': round(total, 3),
+                        'stages': {stage.pop('stage'): stage for stage in report['stages']},
+                    })
+    finally:
+        server.shutdown()
+    return results
+
+def format_results(results):
+    """
+    Format the results as a table of wall times in seconds.
+
+    Args:
+        results (list): The results of run_benchmark.
+
+    Returns:
+        str: The table.
+    """
+    stages = []
+    for result in results:
+        stages.extend(stage for stage in result['stages'] if stage not in stages)
+    header = ['words', 'fx', 'run'] + stages + ['total']
+    rows = [[str(result['words']), result['fx'], str(result['run'])] +
+            [f"{result['stages'][stage]['wall_seconds']:.2f}" if stage in result['stages'] else '-'
+             for stage in stages] +
+            [f"{result['end_to_end_seconds']:.2f}"]
+            for result in results]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in [header] + rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline with a local Pexels stand-in and stub models.")
+    parser.add_argument("--lengths", dest="lengths", default="40,120,240", help="Script lengths in words, separated by commas")
+    parser.add_argument("--effects", dest="effects", default="none,grayscale,vintage,vintage+grayscale",
+                        help="Effect combinations separated by commas, effects of a combination joined with +")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1, help="Runs of every scenario")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the library, scripts and pipeline")
+    parser.add_argument("--clips", dest="clips", type=int, default=160, help="Number of videos in the synthetic library")
+    parser.add_argument("--folder", dest="folder", default="bench/", help="Folder for the library, caches and outputs")
+    parser.add_argument("--warm", dest="warm", action="store_true", help="Keep the caches between runs")
+    parser.add_argument("--profile", dest="profile", help="Render profile, preview, standard or archive")
+    parser.add_argument("--import-budget", dest="import_budget", type=float, default=IMPORT_BUDGET,
+                        help="Maximum import time of the CLI, Pexels and ffmpeg modules, in seconds")
+    parser.add_argument("--imports-only", dest="imports_only", action="store_true", help="Only check the import times")
+    parser.add_argument("-o", "--output", dest="output_file", help="Write the results to a JSON file")
+    args = parser.parse_args()
+
+    imports = check_imports(budget=args.import_budget)
+    for result in imports:
+        heavy = f' (loads {", ".join(result["heavy"])})' if result['heavy'] else ''
+        print(f'import {result["module"]}: {result["seconds"]:.3f}s{heavy}')
+    over_budget = [result['module'] for result in imports if not result['within_budget']]
+    if over_budget:
+        logger.error(f'Import budget of {args.import_budget}s exceeded by {", ".join(over_budget)}')
+    if args.imports_only:
+        raise SystemExit(1 if over_budget else 0)
+
+    fx_sets = [[] if combination == 'none' else combination.split('+') for combination in args.effects.split(',')]
+    results = run_benchmark([int(length) for length in args.lengths.split(',')], fx_sets, repeat=args.repeat,
+                            seed=args.seed, folder=args.folder, clips=args.clips, warm=args.warm,
+                            profile=args.profile)
+    print(format_results(results))
+    if args.output_file:
+        with open(args.output_file, 'w') as file:
+            json.dump({'imports': imports, 'runs': results}, file, indent=2)
+    if over_budget:
+        raise SystemExit(1)
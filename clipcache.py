@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+from contextlib import contextmanager
+from log import logger
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+CLIP_CACHE_FOLDER = os.environ.get('CLIP_CACHE_FOLDER', 'cache/clips/')
+CLIP_CACHE_SIZE = int(os.environ.get('CLIP_CACHE_SIZE', str(5 * 1024 ** 3)))
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+
+@contextmanager
+def _locked_index(cache_folder):
+    """
+    Open the cache index under an exclusive lock shared by every process on the host.
+
+    Yields:
+        dict: The index, written back atomically when the block exits.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(os.path.join(cache_folder, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index_path = os.path.join(cache_folder, INDEX_FILE)
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+
+            yield index
+
+            tmp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _key(media_id, quality):
+    return f'{media_id}_{quality}'
+
+def _link(source, destination):
+    """
+    Hard link a file, falling back to a copy across filesystems.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def clip_path(media_id, quality, cache_folder=CLIP_CACHE_FOLDER):
+    """
+    Get the path of a clip inside the cache.
+
+    Args:
+        media_id (int): The ID of the Pexels video.
+        quality (str): The quality of the video.
+        cache_folder (str): Folder holding the cached clips.
+
+    Returns:
+        str: Path of the cached clip.
+    """
+    return os.path.join(cache_folder, f'{_key(media_id, quality)}.mp4')
+
+def fetch(media_id, quality, output_path, min_duration=None, cache_folder=CLIP_CACHE_FOLDER):
+    """
+    Copy a cached clip to the output path if it is in the cache.
+
+    Args:
+        media_id (int): The ID of the Pexels video.
+        quality (str): The quality of the video.
+        output_path (str): The path to place the clip at.
+        min_duration (float, optional): Number of seconds that will be used from the clip. A cached
+            partial clip shorter than that is a miss.
+        cache_folder (str): Folder holding the cached clips.
+
+    Returns:
+        str: The output path, or None on a cache miss.
+    """
+    key = _key(media_id, quality)
+    with _locked_index(cache_folder) as index:
+        path = clip_path(media_id, quality, cache_folder)
+        if key not in index or not os.path.exists(path):
+            index.pop(key, None)
+            return None
+        duration = index[key].get('duration')
+        if min_duration and duration is not None and duration < min_duration:
+            return None
+        index[key]['last_used'] = time.time()
+        _link(path, output_path)
+
+    logger.info(f'Video id {media_id} found in clip cache')
+    return output_path
+
+def store(media_id, quality, source_path, duration=None, cache_folder=CLIP_CACHE_FOLDER, max_size=CLIP_CACHE_SIZE):
+    """
+    Add a downloaded clip to the cache, evicting the least recently used clips over the size limit.
+
+    Args:
+        media_id (int): The ID of the Pexels video.
+        quality (str): The quality of the video.
+        source_path (str): Path of the downloaded clip.
+        duration (float, optional): Number of seconds downloaded when only the start of the video was
+            fetched, None for the whole video.
+        cache_folder (str): Folder holding the cached clips.
+        max_size (int): Maximum size of the cache in bytes.
+
+    Returns:
+        None
+    """
+    key = _key(media_id, quality)
+    path = clip_path(media_id, quality, cache_folder)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    # copy under a private name and rename so readers never see a partial clip,
+    # unique per call as jobs running as threads of one process may store the same clip
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        _link(source_path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with _locked_index(cache_folder) as index:
+        index[key] = {'size': os.path.getsize(path), 'last_used': time.time(), 'duration': duration}
+
+        total_size = sum(entry['size'] for entry in index.values())
+        for old_key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total_size <= max_size or old_key == key:
+                break
+            total_size -= index.pop(old_key)['size']
+            old_path = os.path.join(cache_folder, f'{old_key}.mp4')
+            if os.path.exists(old_path):
+                os.remove(old_path)
+            logger.info(f'Evicted {old_key} from clip cache')
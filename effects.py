@@ -1,67 +1,313 @@
+import os
+import tempfile
 import subprocess
+from profiles import get_profile
+from probe import probe
 from log import logger  # Assuming logger is properly configured in the 'log' module
+from dotenv import load_dotenv, find_dotenv
 
-def vintage(input_video, output_file, fps='10'):
+
+load_dotenv(find_dotenv())
+
+VINTAGE_TEMPLATE = 'templates/oldFilm1080.mp4'
+GRAIN_CACHE_FOLDER = os.environ.get('GRAIN_CACHE_FOLDER', 'cache/grain/')
+GRAIN_OPACITY = 0.25
+
+# Registered effects by name, see register_effect
+EFFECTS = {}
+
+
+class Effect:
+    """
+    A video effect that can be fused with other effects into a single filter chain.
     """
-    Apply a vintage effect to a video.
 
-    Parameters:
-    - input_video (str): Path to the input video file.
-    - output_file (str): Path to the output video file.
-    - fps (str): Frames per second for the output video.
+    def __init__(self, name, build, fps=None, pix_fmt=None):
+        """
+        Args:
+            name (str): Name of the effect, as given to -fx.
+            build (callable): Function adding the filters of the effect to an EffectChain.
+            fps (str, optional): Frame rate the effect runs at.
+            pix_fmt (str, optional): Pixel format the effect expects.
+        """
+        self.name = name
+        self.build = build
+        self.fps = fps
+        self.pix_fmt = pix_fmt
+
+
+class EffectChain:
+    """
+    Filter chain being built by the effects of a render.
+
+    Effects append filters to the current chain, and can add extra ffmpeg inputs
+    (like the film grain layer) and branch the chain to combine them.
+    """
+
+    def __init__(self, chain, next_input, width, height, start=0):
+        """
+        Args:
+            chain (str): The filter chain so far, starting with its input label.
+            next_input (int): Index of the next ffmpeg input.
+            width (int): Width of the video.
+            height (int): Height of the video.
+            start (float): Position of the chain in the timeline, in seconds.
+        """
+        self.chain = chain
+        self.filters = []
+        self.inputs = []
+        self.next_input = next_input
+        self.width = width
+        self.height = height
+        self.start = start
+        self.fps = None
+        self.pix_fmt = None
+
+    def add(self, fragment):
+        """
+        Append filters to the current chain.
+
+        Args:
+            fragment (str): The filters, separated by commas.
+        """
+        separator = '' if self.chain.endswith(']') else ','
+        self.chain += separator + fragment
+
+    def add_input(self, args):
+        """
+        Add an ffmpeg input used by the chain.
+
+        Args:
+            args (list): The input arguments, ending with '-i' and the path.
+
+        Returns:
+            str: The label of the video stream of the input.
+        """
+        self.inputs.extend(args)
+        label = f'[{self.next_input}:v]'
+        self.next_input += 1
+        return label
+
+    def combine(self, fragment):
+        """
+        Start a new current chain, usually from labelled streams closed before.
+
+        Args:
+            fragment (str): The start of the chain, e.g. '[a][b]blend'.
+        """
+        self.chain = fragment
+
+    def close(self, label):
+        """
+        Close the current chain under a label, so it can be combined with other streams.
+
+        Args:
+            label (str): The label of the chain, e.g. '[vintage]'.
+
+        Returns:
+            str: The label.
+        """
+        self.filters.append(self.chain + label)
+        self.chain = ''
+        return label
+
+
+def register_effect(name, fps=None, pix_fmt=None):
+    """
+    Register an effect so it can be selected with -fx.
+
+    The decorated function receives an EffectChain and appends the filters of the effect.
+
+    Args:
+        name (str): Name of the effect.
+        fps (str, optional): Frame rate the effect runs at. When several effects declare one, the lowest is used.
+        pix_fmt (str, optional): Pixel format the effect expects.
 
     Returns:
-    - None
+        callable: The decorator.
     """
-    logger.info('Applying vintage effect to video')
+    def decorator(build):
+        EFFECTS[name] = Effect(name, build, fps=fps, pix_fmt=pix_fmt)
+        return build
+    return decorator
 
-    # Adjust frame rate
-    framerate_process = subprocess.Popen(['ffmpeg', '-i', input_video, '-filter:v', f'fps={fps}', 'tmp/td-fast.mp4'], text=True)
-    stdout, stderr = framerate_process.communicate()
-
-    if framerate_process.returncode == 0:
-        # Apply vintage effect
-        vintage_process = subprocess.Popen(['ffmpeg', '-i', 'tmp/td-fast.mp4', '-vf', 'curves=vintage', 'tmp/td-vintage-fast.mp4'], text=True)
-        stdout, stderr = vintage_process.communicate()
-
-        if vintage_process.returncode == 0:
-            # Overlay vintage effect on an old film template
-            overlay_process = subprocess.Popen(['ffmpeg',
-                                                '-i', 'templates/oldFilm1080.mp4',
-                                                '-i', 'tmp/td-vintage-fast.mp4',
-                                                '-filter_complex', '[0]format=rgba,colorchannelmixer=aa=0.25[fg];[1][fg]overlay[out]',
-                                                '-map', '[out]',
-                                                '-pix_fmt', 'yuv420p',
-                                                '-c:v', 'libx264',
-                                                '-crf', '23',
-                                                output_file], text=True)
-            _, stderr = overlay_process.communicate()
-
-            if overlay_process.returncode == 0:
-                logger.info('Video successfully filtered with vintage effect')
-
-def grayscale(input_video, output_file):
+def get_effects(fx):
     """
-    Apply a grayscale effect to a video.
+    Get the registered effects for a list of names.
+
+    Args:
+        fx (list): Names of the effects.
+
+    Raises:
+        ValueError: If an effect is not registered.
+
+    Returns:
+        list: The effects, in the same order.
+    """
+    unknown = [name for name in fx if name not in EFFECTS]
+    if unknown:
+        raise ValueError(f'Unknown effects {", ".join(unknown)}, available effects are {", ".join(sorted(EFFECTS))}')
+    return [EFFECTS[name] for name in fx]
+
+def fuse(chain, fx):
+    """
+    Fuse a list of effects into a single filter chain.
+
+    The lowest frame rate required by the effects is applied once before the first
+    one, and the pixel format is only converted when an effect needs a different one.
+
+    Args:
+        chain (EffectChain): The chain to add the effects to.
+        fx (list): Names of the effects, applied in order.
+
+    Returns:
+        EffectChain: The chain.
+    """
+    selected = get_effects(fx)
+    rates = [effect.fps for effect in selected if effect.fps]
+    if rates:
+        chain.fps = min(rates, key=float)
+        chain.add(f'fps={chain.fps}')
+
+    for effect in selected:
+        if effect.pix_fmt and effect.pix_fmt != chain.pix_fmt:
+            chain.add(f'format={effect.pix_fmt}')
+            chain.pix_fmt = effect.pix_fmt
+        effect.build(chain)
+    return chain
+
+def prepare_grain(width, height, fps='10', cache_folder=GRAIN_CACHE_FOLDER):
+    """
+    Get the old film grain layer for a resolution and frame rate, creating it on first use.
+
+    The template is scaled, resampled and converted to yuv420p once and cached, so
+    each render only blends the ready layer instead of decoding and converting the
+    template to rgba every time.
+
+    Args:
+        width (int): Width of the video the grain is applied to.
+        height (int): Height of the video the grain is applied to.
+        fps (str): Frames per second of the effect.
+        cache_folder (str): Folder holding the prepared grain layers.
+
+    Raises:
+        ValueError: If ffmpeg fails to prepare the grain layer.
+
+    Returns:
+        str: Path to the grain layer, meant to be read with -stream_loop -1.
+    """
+    grain_file = os.path.join(cache_folder, f'grain_{width}x{height}_{fps}.mp4')
+    if os.path.exists(grain_file):
+        return grain_file
+
+    logger.info(f'Preparing {width}x{height} film grain at {fps} fps')
+    os.makedirs(cache_folder, exist_ok=True)
+    # a unique name per call, jobs running as threads of one process may prepare the same layer
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(grain_file) + '.', suffix='.tmp.mp4', dir=cache_folder)
+    os.close(fd)
+    try:
+        process = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                    '-i', VINTAGE_TEMPLATE,
+                                    '-vf', f'fps={fps},scale={width}:{height},setsar=1,format=yuv420p',
+                                    '-an', '-c:v', 'libx264', '-crf', '18',
+                                    tmp_file], stderr=subprocess.PIPE, text=True)
+        _, stderr = process.communicate()
+
+        if process.returncode != 0:
+            raise ValueError(f'Unable to prepare film grain: {stderr}')
+        # the last job to finish replaces an identical layer, which is fine
+        os.replace(tmp_file, grain_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return grain_file
+
+@register_effect('vintage', fps='10', pix_fmt='yuv420p')
+def vintage_filter(chain):
+    """
+    Curves and old film grain, blended from the prepared grain layer.
+    """
+    grain_file = prepare_grain(chain.width, chain.height, chain.fps)
+    # start the grain where the previous segment left it so it stays continuous
+    grain_start = chain.start % probe(grain_file).duration
+    grain = chain.add_input(['-stream_loop', '-1', '-ss', f'{grain_start:.3f}', '-i', grain_file])
+
+    chain.add('curves=vintage')
+    video = chain.close('[vintage]')
+    # normal blend mixes top * opacity with bottom * (1 - opacity), so the grain goes on top
+    chain.combine(f'{grain}{video}blend=all_mode=normal:all_opacity={GRAIN_OPACITY}:shortest=1')
+
+@register_effect('grayscale')
+def grayscale_filter(chain):
+    """
+    Remove the colors.
+    """
+    chain.add('hue=s=0')
+
+def apply(input_video, output_file, fx, profile=None):
+    """
+    Apply a list of effects to a video in a single ffmpeg pass.
 
     Parameters:
     - input_video (str): Path to the input video file.
     - output_file (str): Path to the output video file.
+    - fx (list): Names of the effects to apply, in order.
+    - profile (str or RenderProfile): Render profile, defaults to RENDER_PROFILE.
 
     Returns:
     - None
     """
     try:
-        # Apply grayscale effect
-        process = subprocess.Popen(['ffmpeg',
-                                    '-i', input_video,
-                                    '-vf', 'hue=s=0', output_file],
-                                    text=True)
+        profile = get_profile(profile)
+        info = probe(input_video)
+        width, height = profile.size(info.width, info.height)
+        chain = EffectChain('[0:v]', 1, width, height)
+        scale = profile.scale_filter(info.width, info.height)
+        if scale:
+            chain.add(scale)
+        fuse(chain, fx)
+        chain.add('format=yuv420p')
+        chain.close('[out]')
+
+        process = subprocess.Popen(['ffmpeg', '-i', input_video] + chain.inputs +
+                                   ['-filter_complex', ';'.join(chain.filters),
+                                    '-map', '[out]'] +
+                                   profile.encoder_args() +
+                                   [output_file], text=True)
         _, stderr = process.communicate()
 
         if process.returncode == 0:
-            logger.info('Video successfully filtered with grayscale effect')
+            logger.info(f'Video successfully filtered with {", ".join(fx)} effects')
 
     except Exception as e:
         logger.error(f'An error occurred: {e}')
         raise e
+
+def vintage(input_video, output_file, profile=None):
+    """
+    Apply a vintage effect to a video.
+
+    Parameters:
+    - input_video (str): Path to the input video file.
+    - output_file (str): Path to the output video file.
+    - profile (str or RenderProfile): Render profile, defaults to RENDER_PROFILE.
+
+    Returns:
+    - None
+    """
+    logger.info('Applying vintage effect to video')
+    apply(input_video, output_file, ['vintage'], profile=profile)
+
+def grayscale(input_video, output_file, profile=None):
+    """
+    Apply a grayscale effect to a video.
+
+    Parameters:
+    - input_video (str): Path to the input video file.
+    - output_file (str): Path to the output video file.
+    - profile (str or RenderProfile): Render profile, defaults to RENDER_PROFILE.
+
+    Returns:
+    - None
+    """
+    apply(input_video, output_file, ['grayscale'], profile=profile)
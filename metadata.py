@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+METADATA_DB = os.environ.get('METADATA_DB', 'cache/pexels.sqlite3')
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', str(24 * 60 * 60)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_pages (
+    topic TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    per_page INTEGER NOT NULL,
+    ids TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (topic, page, per_page)
+);
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    width INTEGER,
+    height INTEGER,
+    duration REAL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS video_files (
+    video_id INTEGER NOT NULL REFERENCES videos(id),
+    width INTEGER,
+    height INTEGER,
+    fps REAL,
+    link TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS video_files_video_id ON video_files (video_id);
+"""
+
+
+def connect(db_path=METADATA_DB):
+    """
+    Open a connection to the metadata store, creating it if needed.
+
+    Connections are cheap and not shared between threads, so every call site
+    opens its own one.
+
+    Args:
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    folder = os.path.dirname(db_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+def _store_video(connection, video):
+    now = time.time()
+    connection.execute('INSERT OR REPLACE INTO videos (id, width, height, duration, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                       (video['id'], video.get('width'), video.get('height'), video.get('duration'), now))
+    connection.execute('DELETE FROM video_files WHERE video_id = ?', (video['id'],))
+    connection.executemany('INSERT INTO video_files (video_id, width, height, fps, link) VALUES (?, ?, ?, ?, ?)',
+                           [(video['id'], f.get('width'), f.get('height'), f.get('fps'), f['link'])
+                            for f in video.get('video_files') or [] if f.get('link')])
+
+def store_video(video, db_path=METADATA_DB):
+    """
+    Store the metadata of a video as returned by the Pexels API.
+
+    Args:
+        video (dict): The Pexels video object, with its 'video_files'.
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        None
+    """
+    with closing(connect(db_path)) as connection, connection:
+        _store_video(connection, video)
+
+def store_search_page(topic, page, per_page, videos, db_path=METADATA_DB):
+    """
+    Store a page of search results along with the metadata of every video in it.
+
+    Args:
+        topic (str): The topic searched for.
+        page (int): The page number.
+        per_page (int): Number of videos per page.
+        videos (list): The Pexels video objects of the page.
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        None
+    """
+    with closing(connect(db_path)) as connection, connection:
+        for video in videos:
+            _store_video(connection, video)
+        connection.execute('INSERT OR REPLACE INTO search_pages (topic, page, per_page, ids, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                           (topic, page, per_page, json.dumps([video['id'] for video in videos]), time.time()))
+
+def get_search_page(topic, page, per_page, ttl=SEARCH_CACHE_TTL, db_path=METADATA_DB):
+    """
+    Get the video IDs of a cached search page.
+
+    Args:
+        topic (str): The topic searched for.
+        page (int): The page number.
+        per_page (int): Number of videos per page.
+        ttl (int): Maximum age of the cached page in seconds.
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        list: The video IDs, or None if the page is not cached or expired.
+    """
+    with closing(connect(db_path)) as connection:
+        row = connection.execute('SELECT ids, fetched_at FROM search_pages WHERE topic = ? AND page = ? AND per_page = ?',
+                                 (topic, page, per_page)).fetchone()
+    if row is None or time.time() - row['fetched_at'] > ttl:
+        return None
+    return json.loads(row['ids'])
+
+def get_videos(media_ids, db_path=METADATA_DB):
+    """
+    Get the stored metadata of several videos.
+
+    Args:
+        media_ids (list): The IDs of the Pexels videos.
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        dict: Video dicts with 'id', 'width', 'height', 'duration' and 'video_files' keyed by ID.
+              IDs missing from the store are left out.
+    """
+    media_ids = list(media_ids)
+    if not media_ids:
+        return {}
+
+    placeholders = ','.join('?' * len(media_ids))
+    with closing(connect(db_path)) as connection:
+        videos = {row['id']: dict(row, video_files=[])
+                  for row in connection.execute(f'SELECT id, width, height, duration FROM videos WHERE id IN ({placeholders})', media_ids)}
+        for row in connection.execute(f'SELECT video_id, width, height, fps, link FROM video_files WHERE video_id IN ({placeholders})', media_ids):
+            videos[row['video_id']]['video_files'].append({'width': row['width'], 'height': row['height'],
+                                                           'fps': row['fps'], 'link': row['link']})
+    return videos
+
+def get_video(media_id, db_path=METADATA_DB):
+    """
+    Get the stored metadata of a video.
+
+    Args:
+        media_id (int): The ID of the Pexels video.
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        dict: The video metadata, or None if it is not stored.
+    """
+    return get_videos([media_id], db_path).get(media_id)
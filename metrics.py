@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import resource
+import threading
+import subprocess
+from contextlib import contextmanager
+from log import logger
+
+
+# Seconds between two samples of the resident memory of the process
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def _rss(pid='self', field='VmRSS'):
+    """
+    Get the resident memory of a process in bytes, or None where /proc is missing.
+
+    VmHWM gives the peak of the process instead of its current memory.
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def parse_progress(stream):
+    """
+    Parse the output of ffmpeg -progress.
+
+    Args:
+        stream (file): Text stream with the key=value lines written by ffmpeg.
+
+    Yields:
+        dict: One dict per progress block, e.g. {'frame': '120', 'fps': '48.2', 'out_time_ms': ...}.
+    """
+    block = {}
+    for line in stream:
+        key, _, value = line.strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        if key == 'progress':
+            yield block
+            block = {}
+
+def run_ffmpeg(command, metrics=None, on_progress=None):
+    """
+    Run an ffmpeg command while following its progress.
+
+    Args:
+        command (list): The ffmpeg command.
+        metrics (StageMetrics, optional): Stage that receives the progress, encoded frames, encode time, written
+            bytes and peak memory of ffmpeg.
+        on_progress (callable, optional): Called with every progress block.
+
+    Raises:
+        ValueError: If ffmpeg fails.
+
+    Returns:
+        dict: The last progress block.
+    """
+    command = [command[0], '-progress', 'pipe:1', '-nostats'] + command[1:]
+    started = time.perf_counter()
+    run_id = object()
+    last = {}
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+        for last in parse_progress(process.stdout):
+            if metrics is not None:
+                metrics.progress(run_id, last)
+                # read while ffmpeg is alive, the rusage of a child also counts the memory it forked from
+                peak = _rss(process.pid, 'VmHWM')
+                if peak is not None:
+                    metrics.peak('ffmpeg_peak_rss_bytes', peak)
+            if on_progress is not None:
+                on_progress(last)
+    if process.returncode != 0:
+        raise ValueError(f'ffmpeg exited with status {process.returncode}')
+
+    if metrics is not None and last:
+        metrics.count('frames_encoded', int(last.get('frame', 0) or 0))
+        metrics.count('bytes_written', int(last.get('total_size', 0) or 0))
+        metrics.count('encode_seconds', round(time.perf_counter() - started, 3))
+    return last
+
+
+class StageMetrics:
+    """
+    Measurements of a single pipeline stage.
+    """
+
+    def __init__(self, name, listener=None):
+        """
+        Args:
+            name (str): Name of the stage.
+            listener (callable, optional): Called as listener(stage, block) with every ffmpeg progress block.
+        """
+        self.name = name
+        self.values = {}
+        self.listener = listener
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def count(self, key, amount):
+        """
+        Add an amount to a counter of the stage, e.g. 'bytes_downloaded'.
+        """
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, key, value):
+        """
+        Set a value of the stage, e.g. 'encode_fps'.
+        """
+        with self._lock:
+            self.values[key] = value
+
+    def peak(self, key, value):
+        """
+        Keep the largest value seen for a key of the stage, e.g. 'peak_rss_bytes'.
+        """
+        with self._lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def progress(self, run_id, block):
+        """
+        Record a progress block of one of the ffmpeg processes of the stage.
+
+        The output time of every process is summed into 'encoded_seconds', so segments
+        rendered in parallel add up. Compare it to 'target_seconds' when the stage sets it.
+
+        Args:
+            run_id (object): Identifies the ffmpeg process.
+            block (dict): The progress block, see parse_progress.
+        """
+        try:
+            seconds = int(block.get('out_time_us', 0)) / 1000000
+        except ValueError:
+            # out_time_us is N/A until the first frame is written
+            seconds = 0
+        with self._lock:
+            self._progress[run_id] = seconds
+            self.values['encoded_seconds'] = round(sum(self._progress.values()), 3)
+        if self.listener is not None:
+            self.listener(self, block)
+
+
+class _RssSampler:
+    """
+    Background thread sampling the resident memory of the process while stages run.
+
+    One thread serves every running stage and stops when none is left.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stages = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, stage):
+        with self._lock:
+            self.stages.add(stage)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+                self._thread.start()
+        self.sample()
+
+    def remove(self, stage):
+        self.sample()
+        with self._lock:
+            self.stages.discard(stage)
+
+    def sample(self):
+        rss = _rss()
+        if rss is None:
+            return
+        with self._lock:
+            stages = list(self.stages)
+        for stage in stages:
+            stage.peak('peak_rss_bytes', rss)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.stages:
+                    self._thread = None
+                    return
+            self.sample()
+            time.sleep(self.interval)
+
+
+_sampler = _RssSampler()
+
+
+class JobMetrics:
+    """
+    Timing and resource measurements of every stage of a job.
+
+    CPU time includes the ffmpeg processes waited on during the stage. It is measured
+    for the whole process, so it also counts other jobs running at the same time.
+    'peak_rss_bytes' is the largest resident memory of the process sampled while the
+    stage ran, and 'ffmpeg_peak_rss_bytes' the largest of the ffmpeg processes of the stage.
+    """
+
+    def __init__(self, listener=None):
+        """
+        Args:
+            listener (callable, optional): Progress listener given to every stage, see StageMetrics.
+        """
+        self.listener = listener
+        self.stages = []
+        self.started = time.time()
+        self.finished = self.started
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure a stage of the job.
+
+        Args:
+            name (str): Name of the stage, e.g. 'tts' or 'render'.
+
+        Yields:
+            StageMetrics: The stage, to record counters on.
+        """
+        stage = StageMetrics(name, listener=self.listener)
+        with self._lock:
+            self.stages.append(stage)
+        cpu = _cpu_seconds()
+        started = time.perf_counter()
+        _sampler.add(stage)
+        try:
+            yield stage
+        finally:
+            _sampler.remove(stage)
+            stage.set('wall_seconds', round(time.perf_counter() - started, 3))
+            stage.set('cpu_seconds', round(_cpu_seconds() - cpu, 3))
+            if stage.values.get('encode_seconds'):
+                stage.set('encode_fps', round(stage.values['frames_encoded'] / stage.values['encode_seconds'], 2))
+            with self._lock:
+                self.finished = max(self.finished, time.time())
+            logger.info(f'Stage {name} took {stage.values["wall_seconds"]}s')
+
+    def to_dict(self):
+        """
+        Get the measurements as a JSON serializable dict.
+
+        Stages can run at the same time or inside each other, so the total wall time is
+        measured from the start of the job to the end of its last stage.
+
+        Returns:
+            dict: The start time, total wall time and the values of every stage.
+        """
+        with self._lock:
+            stages = [{'stage': stage.name, **stage.values} for stage in self.stages]
+            finished = self.finished
+        return {
+            'started': self.started,
+            'wall_seconds': round(finished - self.started, 3),
+            'stages': stages,
+        }
+
+    def write_report(self, output_file):
+        """
+        Write the measurements as a JSON report.
+
+        Args:
+            output_file (str): Path to the report.
+
+        Returns:
+            str: Path to the report.
+        """
+        with open(output_file, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        return output_file
+
+    def write_prometheus(self, output_file, job='short'):
+        """
+        Export the measurements in the Prometheus text file format, for the node exporter textfile collector.
+
+        Args:
+            output_file (str): Path to the .prom file.
+            job (str): Value of the job label.
+
+        Returns:
+            str: Path to the .prom file.
+        """
+        lines = []
+        for stage in self.to_dict()['stages']:
+            for key, value in stage.items():
+                if key == 'stage' or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f'short_stage_{key}{{job="{job}",stage="{stage["stage"]}"}} {value}')
+
+        # write next to the target and rename so the collector never reads a partial file
+        tmp_file = f'{output_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, output_file)
+        return output_file
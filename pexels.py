@@ -1,120 +1,355 @@
 import requests
 import random
 import os
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from log import logger
-from utils import get_duration
+import clipcache
+import metadata
+import planner
+from probe import probe
 from dotenv import load_dotenv, find_dotenv
 
 
 load_dotenv(find_dotenv())
 
 API_KEY = os.environ.get('API_KEY')
+# Base URL of the Pexels API, can point at a local stand-in like the benchmark server
+API_URL = os.environ.get('PEXELS_API_URL', 'https://api.pexels.com').rstrip('/')
 HEADERS = {"Authorization": API_KEY}
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+CHUNK_SIZE = 1024 * 1024
+# Seconds between two checks of the cancel event while ffmpeg downloads a range
+CANCEL_POLL_INTERVAL = 0.2
+QUALITY_WIDTHS = {'hd': 1920, 'sd': 1280}
 
+# Shared keep-alive session so API calls and downloads reuse their TLS connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS * 2))
 
-def download_videos(topic, output_folder, total_pages):
+
+class DownloadCancelled(Exception):
+    """
+    Raised when a download is stopped because its content is no longer needed.
+    """
+
+
+def download_videos(topic, workspace, total_pages, workers=DOWNLOAD_WORKERS, quality='hd', duration=None,
+                    estimate=None):
     """
     Download videos related to the given topic until the total duration exceeds the duration of an audio file.
 
+    The clips are planned up front from the durations in the metadata store, so only the
+    clips needed to cover the audio are downloaded, up to `workers` at the same time, and
+    clips that will be trimmed are only fetched up to the part that is used. A clip that
+    fails to download is replaced by a new plan for its share of the duration.
+
+    The duration can be a future, e.g. while the speech is still being synthesized. The
+    downloads then start from the estimate, and once the real duration is known the plan
+    is reconciled: clips that are no longer needed are cancelled and missing footage is
+    planned and downloaded.
+
     Args:
         topic (str): The topic for which videos are to be downloaded.
-        output_folder (str): The folder where downloaded videos will be saved.
+        workspace (Workspace): Workspace of the job, holding the audio and the downloaded videos.
         total_pages (int): The total number of pages to fetch video IDs.
+        workers (int, optional): Number of concurrent downloads.
+        quality (str): The quality of the videos, either 'hd' (1920) or 'sd' (1280).
+        duration (float or Future, optional): Seconds of footage needed, or a future resolving to them.
+            Defaults to the duration of the workspace audio.
+        estimate (float, optional): Seconds of footage planned while the duration future is not resolved.
 
     Raises:
         Exception: If an error occurs during the video download process.
 
     Returns:
-        None
+        list: Paths of the downloaded videos, in playback order.
     """
-    ids_list = fetch_video_ids(topic, total_pages=total_pages)
-    audio_duration = get_duration('tmp/t2s.wav')
-    video_duration = 0
-    downloaded_ids = []
+    with workspace.metrics.stage('search'):
+        ids_list = fetch_video_ids(topic, total_pages=total_pages)
 
-    while video_duration < audio_duration:
+    final_duration = duration if isinstance(duration, Future) else None
+    if final_duration is None:
+        audio_duration = duration or probe(workspace.audio_file).duration
+    elif final_duration.done() or not estimate:
+        audio_duration = final_duration.result()
+        final_duration = None
+    else:
+        logger.info(f'Planning footage for an estimated {estimate:.1f}s of audio')
+        audio_duration = estimate
+
+    candidates = list(metadata.get_videos(ids_list).values())
+    width = QUALITY_WIDTHS[quality]
+    plan = planner.plan_clips(candidates, audio_duration, width=width)
+    used_ids = {entry['id'] for entry in plan}
+    # planned clips in playback order, with their download future and cancel event
+    timeline = []
+    pending = {}
+    downloaded = set()
+
+    with workspace.metrics.stage('download') as stage, ThreadPoolExecutor(max_workers=workers) as executor:
+        def schedule(entries):
+            for entry in entries:
+                entry = dict(entry, path=workspace.pexels_folder + f'{entry["id"]}.mp4', cancel=threading.Event())
+                timeline.append(entry)
+                future = executor.submit(download_pexels_video, entry['id'], entry['path'], quality=quality,
+                                         cancel_event=entry['cancel'], max_duration=entry['duration'], metrics=stage)
+                pending[future] = entry
+
+        def reconcile(target):
+            covered = 0
+            for entry in list(timeline):
+                if covered >= target + planner.DURATION_MARGIN:
+                    entry['cancel'].set()
+                    timeline.remove(entry)
+                    if entry['path'] in downloaded:
+                        os.remove(entry['path'])
+                else:
+                    covered += entry['duration']
+            for future, entry in list(pending.items()):
+                if entry not in timeline and future.cancel():
+                    pending.pop(future)
+            missing = target + planner.DURATION_MARGIN - covered
+            if missing > 0:
+                extra = planner.plan_clips([c for c in candidates if c['id'] not in used_ids], missing,
+                                           width=width, margin=0)
+                used_ids.update(entry['id'] for entry in extra)
+                schedule(extra)
+            logger.info(f'Footage reconciled with {target:.1f}s of audio, {len(timeline)} clips planned')
+
+        schedule(plan)
         try:
-            current_video_id = random.choice(ids_list)
-            if current_video_id not in downloaded_ids:
-                try:
-                    output_video = output_folder + f'{current_video_id}.mp4'
-                    download_pexels_video(current_video_id, output_video)
-                    video_duration += get_duration(output_video)
-                    downloaded_ids.append(current_video_id)
-                except Exception as e:
-                    # Log or handle the exception appropriately
-                    pass
-        except Exception as e:
-            # Log or handle the exception appropriately
-            raise e
+            while pending or final_duration:
+                waiting = list(pending) + ([final_duration] if final_duration else [])
+                done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                if final_duration in done:
+                    audio_duration = final_duration.result()
+                    final_duration = None
+                    reconcile(audio_duration)
+                for future in done:
+                    entry = pending.pop(future, None)
+                    if entry is None:
+                        continue
+                    if entry not in timeline:
+                        # cancelled while running, drop what it managed to download
+                        if future.exception() is None:
+                            os.remove(entry['path'])
+                        continue
+                    try:
+                        downloaded.add(future.result())
+                    except Exception as e:
+                        logger.warning(f'Replacing video id {entry["id"]}: {e}')
+                        timeline.remove(entry)
+                        replacement = planner.plan_clips([c for c in candidates if c['id'] not in used_ids],
+                                                         entry['duration'], width=width, margin=0)
+                        used_ids.update(r['id'] for r in replacement)
+                        schedule(replacement)
+        except BaseException:
+            # the speech failed or the loop broke, stop the speculative downloads instead of waiting for them
+            for entry in timeline:
+                entry['cancel'].set()
+            for future in pending:
+                future.cancel()
+            raise
+
+    clips = [entry for entry in timeline if entry['path'] in downloaded]
+    video_duration = sum(entry['duration'] for entry in clips)
+    if video_duration < audio_duration:
+        logger.warning(f'Videos for {topic} only cover {video_duration:.1f}s of {audio_duration:.1f}s of audio')
+    return [entry['path'] for entry in clips]
 
-def download(url, output_path):
+def download(url, output_path, cancel_event=None, metrics=None):
     """
-    Download content from a given URL and save it to the specified output path.
+    Download content from a given URL and stream it to the specified output path.
+
+    The content is written in chunks to a temporary file that is renamed once
+    complete, so a partial download never shows up at the output path.
 
     Args:
         url (str): The URL of the content to download.
         output_path (str): The path to save the downloaded content.
+        cancel_event (threading.Event, optional): Stops the download when set.
+        metrics (StageMetrics, optional): Stage that receives the downloaded bytes.
 
     Raises:
+        DownloadCancelled: If the download was cancelled.
         Exception: If there is an issue with the download.
     """
+    tmp_path = output_path + '.part'
     try:
-        with open(output_path, "wb") as f:
-            f.write(requests.get(url, timeout=15).content)
+        with SESSION.get(url, timeout=15, stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise DownloadCancelled(f'Download of {url} was cancelled')
+                    f.write(chunk)
+                    if metrics is not None:
+                        metrics.count('bytes_downloaded', len(chunk))
+        os.replace(tmp_path, output_path)
+    except DownloadCancelled:
+        os.remove(tmp_path)
+        raise
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         logger.error(f'Failed to download content from {url}: {e}')
         raise e
 
-def download_pexels_video(media_id, output_path, quality='hd'):
+def cut_clip(source, output_path, duration, cancel_event=None):
+    """
+    Keep only the first seconds of a video, without re-encoding.
+
+    ffmpeg stream copies the packets up to the requested duration. A remote source is
+    read with HTTP range requests, so the rest of the file is never fetched.
+
+    Args:
+        source (str): Path or URL of the video.
+        output_path (str): The path to save the cut clip.
+        duration (float): Number of seconds to keep.
+        cancel_event (threading.Event, optional): Stops ffmpeg when set.
+
+    Raises:
+        DownloadCancelled: If the cut was cancelled.
+        ValueError: If ffmpeg fails to cut the video.
+    """
+    tmp_path = output_path + '.part.mp4'
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-t', str(duration), '-i', source,
+               '-map', '0:v:0', '-c', 'copy', '-movflags', '+faststart', tmp_path]
+    stream = subprocess.Popen(command, stderr=subprocess.PIPE, text=True)
+    try:
+        while True:
+            try:
+                _, stderr = stream.communicate(timeout=CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    stream.kill()
+                    stream.wait()
+                    stream.stderr.close()
+                    raise DownloadCancelled(f'Download of {source} was cancelled')
+
+        if stream.returncode != 0:
+            raise ValueError(f'Unable to cut {duration}s of {source}: {stderr}')
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def download_range(url, output_path, duration, cancel_event=None, metrics=None):
+    """
+    Download only the first seconds of a remote video.
+
+    Args:
+        url (str): The URL of the video.
+        output_path (str): The path to save the downloaded part.
+        duration (float): Number of seconds to keep.
+        cancel_event (threading.Event, optional): Stops the download when set.
+        metrics (StageMetrics, optional): Stage that receives the downloaded bytes.
+
+    Raises:
+        DownloadCancelled: If the download was cancelled.
+        ValueError: If ffmpeg fails to download the video.
+    """
+    cut_clip(url, output_path, duration, cancel_event=cancel_event)
+    if metrics is not None:
+        metrics.count('bytes_downloaded', os.path.getsize(output_path))
+
+def download_pexels_video(media_id, output_path, quality='hd', cancel_event=None, max_duration=None, metrics=None):
     """
     Download a Pexels video with a given media ID and save it to the specified output path.
 
+    The local clip cache is checked first and every download is added to it. Long
+    videos are only downloaded up to max_duration, and cached clips longer than that
+    are cut locally, so the clip always matches the planned duration.
+
     Args:
         media_id (int): The ID of the Pexels video.
         output_path (str): The path to save the downloaded video.
         quality (str): The quality of the video, either 'hd' (1920) or 'sd' (1280).
+        cancel_event (threading.Event, optional): Stops the download when set.
+        max_duration (float, optional): Number of seconds that will be used from the video. Longer
+            videos are only partially downloaded, and cached as partial clips.
+        metrics (StageMetrics, optional): Stage that receives the downloaded bytes and cache hits.
 
     Raises:
         ValueError: If the specified quality is not supported or there is no video available for the given ID.
+        DownloadCancelled: If the download was cancelled.
         Exception: If there is an issue with the download.
     """
     try:
-        if quality == 'hd':
-            quality = 1920
-        elif quality == 'sd':
-            quality = 1280
+        if quality in QUALITY_WIDTHS:
+            quality = QUALITY_WIDTHS[quality]
         else:
             raise ValueError('Quality provided is not supported. Use quality="hd" or quality="sd"')
 
-        url = f"https://api.pexels.com/videos/videos/{media_id}"
-        response = requests.get(url, headers=HEADERS)
-        link = None
+        # keep a margin so the clip still covers its slot after trimming to whole frames
+        needed = max_duration + planner.DURATION_MARGIN if max_duration else None
+        if clipcache.fetch(media_id, quality, output_path, min_duration=needed):
+            if metrics is not None:
+                metrics.count('cache_hits', 1)
+            if needed and probe(output_path).duration > needed:
+                cut_clip(output_path, output_path, needed, cancel_event=cancel_event)
+            return output_path
+
+        video = get_video_metadata(media_id)
 
-        if response.status_code == 200:
-            data = response.json()
-            videos = data.get("video_files")
+        try:
+            selected_video = next(filter(lambda x: x['width'] == quality, video['video_files']))
+            link = selected_video.get('link')
+        except Exception as e:
+            raise ValueError(f'There is no {quality} video available for id {media_id}, trying another id...')
 
-            try:
-                print('')
-                selected_video = next(filter(lambda x: x['width'] == quality, videos))
-                link = selected_video.get('link')
-            except Exception as e:
-                raise ValueError(f'There is no {quality} video available for id {media_id}, trying another id...')
-
-            download(link, output_path)
-            logger.info(f'Video id {media_id} downloaded successfully')
-            return output_path
+        if needed and video.get('duration') and video['duration'] > needed:
+            download_range(link, output_path, needed, cancel_event=cancel_event, metrics=metrics)
+            clipcache.store(media_id, quality, output_path, duration=needed)
         else:
-            raise ValueError(f'Unable to get video with status code {response.status_code} and response {response.text}')
+            download(link, output_path, cancel_event=cancel_event, metrics=metrics)
+            clipcache.store(media_id, quality, output_path)
+        logger.info(f'Video id {media_id} downloaded successfully')
+        return output_path
+    except DownloadCancelled:
+        raise
     except Exception as e:
         logger.error(f'Failed to download Pexels video with id {media_id}: {e}')
         raise e
 
+def get_video_metadata(media_id):
+    """
+    Get the metadata of a Pexels video, from the local metadata store when possible.
+
+    Args:
+        media_id (int): The ID of the Pexels video.
+
+    Raises:
+        ValueError: If the video cannot be fetched from the API.
+
+    Returns:
+        dict: The video metadata with its 'duration' and 'video_files'.
+    """
+    video = metadata.get_video(media_id)
+    if video is not None:
+        return video
+
+    url = f"{API_URL}/videos/videos/{media_id}"
+    response = SESSION.get(url, headers=HEADERS, timeout=15)
+
+    if response.status_code != 200:
+        raise ValueError(f'Unable to get video with status code {response.status_code} and response {response.text}')
+
+    video = response.json()
+    metadata.store_video(video)
+    return video
+
 def fetch_video_ids(topic, per_page=80, total_pages=100):
     """
     Fetch video IDs for a given topic from the Pexels API.
 
+    Search pages are cached in the metadata store for SEARCH_CACHE_TTL seconds, along
+    with the metadata of every video they contain.
+
     Args:
         topic (str): The topic to search for.
         per_page (int, optional): Number of videos per page (max 80). Defaults to 80.
@@ -131,21 +366,28 @@ def fetch_video_ids(topic, per_page=80, total_pages=100):
         if per_page > 80:
             raise ValueError('Max per_page parameter is 80')
 
-        url = "https://api.pexels.com/v1/videos/search"
+        url = f"{API_URL}/v1/videos/search"
         all_ids = []
 
         for _ in range(total_pages):
             page = random.randint(1, total_pages)
+            cached_ids = metadata.get_search_page(topic, page, per_page)
+            if cached_ids:
+                logger.info(f'Using cached IDs from page {page}')
+                all_ids.extend(cached_ids)
+                return all_ids
+
             logger.info(f'Fetching IDs from page {page}')
             query_params = {"query": topic, "per_page": per_page, "page": page}
 
-            response = requests.get(url, params=query_params, headers=HEADERS)
+            response = SESSION.get(url, params=query_params, headers=HEADERS, timeout=15)
 
             if response.status_code == 200:
                 data = response.json()
                 all_media = data.get('videos', [])
 
                 if all_media:
+                    metadata.store_search_page(topic, page, per_page, all_media)
                     all_ids.extend(media['id'] for media in all_media)
                     return all_ids
 
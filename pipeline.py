@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from log import logger
+from metrics import JobMetrics
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+PIPELINE_CACHE_FOLDER = os.environ.get('PIPELINE_CACHE_FOLDER', 'cache/stages/')
+PIPELINE_CACHE_SIZE = int(os.environ.get('PIPELINE_CACHE_SIZE', str(20 * 1024 ** 3)))
+# Stage folders used this recently are never evicted, they may be read by a running job
+PIPELINE_CACHE_MIN_AGE = 60 * 60
+MANIFEST = 'manifest.json'
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link a file, or copy it when it is on another file system.
+
+    Args:
+        source (str): Path of the file.
+        destination (str): Path of the link or copy.
+
+    Returns:
+        str: The destination path.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+    return destination
+
+
+def _folder_size(folder):
+    """
+    Get the size of the files in a folder and its subfolders, in bytes.
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+
+class Pipeline:
+    """
+    DAG of stages whose outputs are cached by a hash of their inputs and parameters.
+
+    The key of a stage hashes its name, its parameters and the keys of the stages it
+    reads from, so a stage only runs again when something upstream of it changed.
+    Every stage writes its files in its own folder of the cache, which is kept when
+    a later stage fails, so a retry resumes where the previous attempt stopped. The
+    least recently used folders are evicted once the cache grows over its size limit.
+    """
+
+    def __init__(self, cache_folder=PIPELINE_CACHE_FOLDER, metrics=None, work_folder=None,
+                 max_size=PIPELINE_CACHE_SIZE):
+        """
+        Args:
+            cache_folder (str): Folder holding the outputs of every stage.
+            metrics (JobMetrics, optional): Measurements of the job, a new one is used when omitted.
+            work_folder (str, optional): Folder holding the outputs of the stages that are not cached.
+            max_size (int): Size of the cache in bytes above which stage folders are evicted.
+        """
+        self.cache_folder = cache_folder
+        self.work_folder = work_folder
+        self.max_size = max_size
+        self.metrics = metrics or JobMetrics()
+        self.stages = {}
+        self._results = {}
+
+    def add(self, name, run, params=None, inputs=(), executor=None, cache=True):
+        """
+        Add a stage to the pipeline.
+
+        The stage is called as run(folder, *input_files, metrics=stage_metrics), with the
+        output files of every input stage, and returns the paths of the files it wrote
+        inside folder.
+
+        Args:
+            name (str): Name of the stage.
+            run (callable): Function producing the outputs of the stage.
+            params (dict, optional): JSON serializable parameters that change the outputs.
+            inputs (tuple): Names of the stages whose outputs are read, added before this one.
+            executor (Executor, optional): Executor running the stage, e.g. a pool limiting a resource.
+            cache (bool): Keep the outputs in the cache. Stages that are not cached, like the final
+                render, run every time in the work folder.
+
+        Raises:
+            ValueError: If the stage already exists, reads from an unknown stage, or is not cached
+                without a work folder.
+        """
+        if name in self.stages:
+            raise ValueError(f'Stage {name} is already in the pipeline')
+        unknown = [stage for stage in inputs if stage not in self.stages]
+        if unknown:
+            raise ValueError(f'Stage {name} reads from unknown stages {", ".join(unknown)}')
+        if not cache and self.work_folder is None:
+            raise ValueError(f'Stage {name} is not cached, the pipeline needs a work folder')
+        self.stages[name] = {'run': run, 'params': params or {}, 'inputs': tuple(inputs), 'executor': executor,
+                             'cache': cache}
+
+    def key(self, name):
+        """
+        Get the cache key of a stage.
+
+        Args:
+            name (str): Name of the stage.
+
+        Returns:
+            str: The sha256 of the stage, its parameters and the keys of its inputs.
+        """
+        stage = self.stages[name]
+        data = json.dumps({'stage': name, 'params': stage['params'],
+                           'inputs': [self.key(input_name) for input_name in stage['inputs']]}, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def folder(self, name):
+        """
+        Get the cache folder of a stage.
+
+        Args:
+            name (str): Name of the stage.
+
+        Returns:
+            str: The folder holding the outputs of the stage.
+        """
+        return os.path.join(self.cache_folder, name, self.key(name))
+
+    def future(self, name):
+        """
+        Get the future of a stage while the pipeline runs.
+
+        This lets a stage start before another one finishes and pick up its outputs
+        later. The stage being waited for is not an input, so its parameters that matter
+        have to be in the parameters of the waiting stage.
+
+        Args:
+            name (str): Name of the stage, added before the stage asking for it.
+
+        Returns:
+            Future: Resolves to the output files of the stage.
+        """
+        return self._results[name]
+
+    def _load(self, folder):
+        manifest = os.path.join(folder, MANIFEST)
+        try:
+            with open(manifest, 'r') as file:
+                files = [os.path.join(folder, name) for name in json.load(file)['files']]
+        except FileNotFoundError:
+            return None
+        # the modification time of the manifest is the last use of the folder, see prune
+        os.utime(manifest)
+        return files
+
+    def _call(self, name, folder, inputs):
+        stage = self.stages[name]
+
+        def call():
+            with self.metrics.stage(name) as stage_metrics:
+                return stage['run'](folder, *inputs, metrics=stage_metrics)
+
+        return stage['executor'].submit(call).result() if stage['executor'] else call()
+
+    def _execute(self, name, results):
+        stage = self.stages[name]
+        inputs = [results[input_name].result() for input_name in stage['inputs']]
+
+        if not stage['cache']:
+            folder = os.path.join(self.work_folder, name)
+            os.makedirs(folder, exist_ok=True)
+            return self._call(name, folder, inputs)
+
+        folder = self.folder(name)
+        outputs = self._load(folder)
+        if outputs is not None:
+            logger.info(f'Stage {name} is up to date, reusing {folder}')
+            with self.metrics.stage(name) as stage_metrics:
+                stage_metrics.count('cache_hits', 1)
+            return outputs
+
+        # build in a private folder and rename it, so a stage is either complete or missing
+        tmp_folder = f'{folder}.{os.getpid()}.{threading.get_ident()}.tmp'
+        os.makedirs(tmp_folder)
+
+        try:
+            files = self._call(name, tmp_folder, inputs)
+            names = [os.path.relpath(path, tmp_folder) for path in files]
+            if any(name.startswith('..') for name in names):
+                raise ValueError(f'Stage {name} wrote outputs outside of its folder')
+            with open(os.path.join(tmp_folder, MANIFEST), 'w') as file:
+                json.dump({'stage': name, 'params': stage['params'], 'files': names}, file)
+            try:
+                os.rename(tmp_folder, folder)
+            except OSError:
+                # the same stage was completed by another job in the meantime
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+        return self._load(folder)
+
+    def prune(self, max_size=None, min_age=PIPELINE_CACHE_MIN_AGE):
+        """
+        Evict the least recently used stage folders until the cache fits in its size limit.
+
+        Folders used in the last min_age seconds are kept, as a running job may still read
+        them, and so are the private folders of stages being built, unless they are older
+        than that and were left behind by a crashed job.
+
+        Hard links to the clip cache are counted, as they keep evicted clips on disk.
+
+        Args:
+            max_size (int, optional): Size limit in bytes. Defaults to the limit of the pipeline.
+            min_age (float): Seconds since the last use before a folder can be evicted.
+
+        Returns:
+            int: Number of evicted folders.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        now = time.time()
+        folders = []
+        total_size = 0
+        for stage_name in os.listdir(self.cache_folder) if os.path.isdir(self.cache_folder) else []:
+            stage_folder = os.path.join(self.cache_folder, stage_name)
+            if not os.path.isdir(stage_folder):
+                continue
+            for key in os.listdir(stage_folder):
+                folder = os.path.join(stage_folder, key)
+                try:
+                    if key.endswith('.tmp'):
+                        if now - os.path.getmtime(folder) > min_age:
+                            shutil.rmtree(folder, ignore_errors=True)
+                        continue
+                    last_used = os.path.getmtime(os.path.join(folder, MANIFEST))
+                    size = _folder_size(folder)
+                except OSError:
+                    # evicted by another job in the meantime
+                    continue
+                folders.append((last_used, size, folder))
+                total_size += size
+
+        evicted = 0
+        for last_used, size, folder in sorted(folders):
+            if total_size <= max_size or now - last_used < min_age:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total_size -= size
+            evicted += 1
+        if evicted:
+            logger.info(f'Evicted {evicted} stage folders from {self.cache_folder}')
+        return evicted
+
+    def run(self):
+        """
+        Run every stage whose outputs are not cached yet.
+
+        Stages start as soon as their inputs are ready, so independent stages run at the same time.
+        The cache is pruned to its size limit afterwards.
+
+        Raises:
+            Exception: The error of the first failed stage, after the other stages finished.
+
+        Returns:
+            dict: The output files of every stage, by name.
+        """
+        results = self._results = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(self.stages)), thread_name_prefix='stage') as drivers:
+                for name in self.stages:
+                    results[name] = drivers.submit(self._execute, name, results)
+            return {name: future.result() for name, future in results.items()}
+        finally:
+            try:
+                self.prune()
+            except Exception as e:
+                logger.warning(f'Unable to prune the stage cache: {e}')
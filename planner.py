@@ -0,0 +1,61 @@
+import random
+
+MAX_CLIP_DURATION = 15
+DURATION_MARGIN = 1.0
+
+
+def has_width(video, width):
+    """
+    Check if a video has a file with the given width.
+
+    Args:
+        video (dict): The video metadata with its 'video_files'.
+        width (int): The width of the file.
+
+    Returns:
+        bool: True if a file with that width is available.
+    """
+    return any(f.get('width') == width for f in video.get('video_files') or [])
+
+def plan_clips(videos, target_duration, width=1920, max_clip_duration=MAX_CLIP_DURATION,
+               margin=DURATION_MARGIN, seed=None):
+    """
+    Pick the smallest set of clips whose durations cover the target duration.
+
+    Each clip contributes at most max_clip_duration seconds so a single long clip
+    does not fill the whole short. Clips are taken longest first, and the last one
+    is the shortest clip that still covers what is left, so as little footage as
+    possible is downloaded and then thrown away by the trim. Ties are broken
+    randomly to keep variety between runs.
+
+    Args:
+        videos (list): Candidate video metadata dicts with 'id', 'duration' and 'video_files'.
+        target_duration (float): Duration to cover in seconds.
+        width (int): Width of the files to use.
+        max_clip_duration (float): Maximum number of seconds used from a single clip.
+        margin (float): Extra seconds covered to absorb rounded durations.
+        seed (int, optional): Seed for the tie breaking. The global random generator is used when omitted.
+
+    Returns:
+        list: Plan entries as dicts with the 'id' of the video and the 'duration' to use from it.
+              The plan may fall short of the target when there are not enough candidates.
+    """
+    candidates = [video for video in videos if video.get('duration') and has_width(video, width)]
+    (random if seed is None else random.Random(seed)).shuffle(candidates)
+
+    def usable(video):
+        return min(video['duration'], max_clip_duration)
+
+    candidates.sort(key=usable, reverse=True)
+    remaining = target_duration + margin
+    plan = []
+
+    while remaining > 0 and candidates:
+        fits = [video for video in candidates if usable(video) >= remaining]
+        choice = min(fits, key=usable) if fits else candidates[0]
+        candidates.remove(choice)
+        duration = min(usable(choice), remaining)
+        plan.append({'id': choice['id'], 'duration': duration})
+        remaining -= duration
+
+    return plan
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import subprocess
+from fractions import Fraction
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+PROBE_DB = os.environ.get('PROBE_DB', 'cache/probe.sqlite3')
+PROBE_CACHE_TTL = int(os.environ.get('PROBE_CACHE_TTL', str(30 * 24 * 60 * 60)))
+PROBE_MEMO_SIZE = 4096
+PROBE_WORKERS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    probed_at REAL NOT NULL
+);
+"""
+
+STREAM_ENTRIES = ('codec_type', 'codec_name', 'width', 'height', 'pix_fmt', 'time_base', 'r_frame_rate', 'duration')
+
+
+class MediaInfo(namedtuple('MediaInfo', ('duration', 'codec_name', 'width', 'height', 'pix_fmt', 'time_base',
+                                         'r_frame_rate'))):
+    """
+    Probed parameters of a media file.
+
+    The stream fields describe the first video stream, they are None for audio files.
+    """
+
+    __slots__ = ()
+
+    @property
+    def fps(self):
+        """
+        float: Frames per second of the video stream, or None for audio files.
+        """
+        if not self.r_frame_rate or self.r_frame_rate == '0/0':
+            return None
+        return float(Fraction(self.r_frame_rate))
+
+    @property
+    def concat_signature(self):
+        """
+        tuple: The stream parameters that have to match for videos to be concatenated without re-encoding.
+        """
+        return (self.codec_name, self.width, self.height, self.pix_fmt, self.time_base)
+
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_pruned = set()
+
+
+def connect(db_path=PROBE_DB):
+    """
+    Open a connection to the probe cache, creating it if needed.
+
+    Entries older than PROBE_CACHE_TTL are removed the first time a process opens the cache.
+
+    Args:
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    folder = os.path.dirname(db_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    if db_path not in _pruned:
+        _pruned.add(db_path)
+        with connection:
+            connection.execute('DELETE FROM probes WHERE probed_at < ?', (time.time() - PROBE_CACHE_TTL,))
+    return connection
+
+def _key(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+def _remember(key, info):
+    with _memo_lock:
+        _memo[key] = info
+        _memo.move_to_end(key)
+        while len(_memo) > PROBE_MEMO_SIZE:
+            _memo.popitem(last=False)
+
+def _recall(key):
+    with _memo_lock:
+        info = _memo.get(key)
+        if info is not None:
+            _memo.move_to_end(key)
+        return info
+
+def run_ffprobe(path):
+    """
+    Probe a media file with a single ffprobe call, without using the cache.
+
+    Args:
+        path (str): Path of the media file.
+
+    Raises:
+        ValueError: If ffprobe fails or the file has no duration.
+
+    Returns:
+        MediaInfo: The parameters of the file.
+    """
+    command = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration:stream=' + ','.join(STREAM_ENTRIES),
+        '-of', 'json',
+        path,
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ValueError(f'Unable to probe {path}: {result.stderr.strip()}')
+
+    data = json.loads(result.stdout)
+    streams = data.get('streams') or []
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    duration = data.get('format', {}).get('duration') or next(
+        (stream['duration'] for stream in streams if stream.get('duration') not in (None, 'N/A')), None)
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        raise ValueError(f'Unable to get the duration of {path}')
+
+    codec_name = video.get('codec_name') or (streams[0].get('codec_name') if streams else None)
+    return MediaInfo(duration, codec_name, video.get('width'), video.get('height'), video.get('pix_fmt'),
+                     video.get('time_base'), video.get('r_frame_rate'))
+
+def probe_many(paths, workers=PROBE_WORKERS, db_path=PROBE_DB):
+    """
+    Probe several media files, reusing the results of files that did not change.
+
+    Results are memoized in the process and in the probe cache, keyed by the path,
+    size and modification time of the file. The cache is read and written once for
+    all the files, and the files missing from it are probed in parallel.
+
+    Args:
+        paths (list): Paths of the media files.
+        workers (int): Number of ffprobe processes running at the same time.
+        db_path (str): Path of the SQLite database, or None to only memoize in the process.
+
+    Raises:
+        ValueError: If a file cannot be probed.
+
+    Returns:
+        list: The MediaInfo of every file, in the same order.
+    """
+    keys = [_key(path) for path in paths]
+    infos = {key: _recall(key) for key in keys}
+    missing = [key for key, info in infos.items() if info is None]
+    if not missing:
+        return [infos[key] for key in keys]
+
+    if db_path:
+        with closing(connect(db_path)) as connection:
+            names = [path for path, _, _ in missing]
+            rows = connection.execute(f'SELECT path, size, mtime_ns, info FROM probes WHERE path IN '
+                                      f'({",".join("?" * len(names))})', names).fetchall()
+        stored = {(row['path'], row['size'], row['mtime_ns']): row['info'] for row in rows}
+        for key in missing:
+            if key in stored:
+                infos[key] = MediaInfo(*json.loads(stored[key]))
+                _remember(key, infos[key])
+        missing = [key for key in missing if infos[key] is None]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            for key, info in zip(missing, executor.map(run_ffprobe, [path for path, _, _ in missing])):
+                infos[key] = info
+                _remember(key, info)
+        if db_path:
+            now = time.time()
+            with closing(connect(db_path)) as connection, connection:
+                connection.executemany('INSERT OR REPLACE INTO probes (path, size, mtime_ns, info, probed_at) '
+                                       'VALUES (?, ?, ?, ?, ?)',
+                                       [(*key, json.dumps(infos[key]), now) for key in missing])
+    return [infos[key] for key in keys]
+
+def probe(path, db_path=PROBE_DB):
+    """
+    Probe a media file, reusing the result if the file did not change.
+
+    Args:
+        path (str): Path of the media file.
+        db_path (str): Path of the SQLite database, or None to only memoize in the process.
+
+    Raises:
+        ValueError: If the file cannot be probed.
+
+    Returns:
+        MediaInfo: The parameters of the file.
+    """
+    return probe_many([path], db_path=db_path)[0]
+
+def probe_folder(folder, extensions=('.mp4', '.mov', '.mkv', '.webm', '.wav', '.mp3'), db_path=PROBE_DB):
+    """
+    Probe every media file of a folder in one batch.
+
+    Args:
+        folder (str): Path of the folder.
+        extensions (tuple): Extensions of the files to probe.
+        db_path (str): Path of the SQLite database, or None to only memoize in the process.
+
+    Returns:
+        dict: The MediaInfo of every file, keyed by path.
+    """
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                   if name.lower().endswith(extensions) and os.path.isfile(os.path.join(folder, name)))
+    return dict(zip(paths, probe_many(paths, db_path=db_path)))
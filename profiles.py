@@ -0,0 +1,110 @@
+import os
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', 'standard')
+
+
+class RenderProfile:
+    """
+    Output settings shared by every encode of a render.
+
+    Profiles only use libx264 software presets, so the same profile gives the same
+    output on every machine.
+    """
+
+    def __init__(self, name, height=None, fps='30', preset='medium', crf=23, threads=None):
+        """
+        Args:
+            name (str): Name of the profile, as given to --profile.
+            height (int, optional): Output height, the width follows the aspect ratio. The source size is kept when omitted.
+            fps (str): Frames per second of the output.
+            preset (str): libx264 preset.
+            crf (int): libx264 constant rate factor.
+            threads (int, optional): Encoder threads, chosen by ffmpeg when omitted.
+        """
+        self.name = name
+        self.height = height
+        self.fps = fps
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+
+    def size(self, width, height):
+        """
+        Get the output size for a source size.
+
+        Args:
+            width (int): Width of the source.
+            height (int): Height of the source.
+
+        Returns:
+            tuple: The output (width, height), both even.
+        """
+        if not self.height or self.height >= height:
+            return width, height
+        return int(round(width * self.height / height / 2)) * 2, self.height
+
+    def scale_filter(self, width, height):
+        """
+        Get the filter downscaling a source to the profile, if needed.
+
+        Args:
+            width (int): Width of the source.
+            height (int): Height of the source.
+
+        Returns:
+            str: The scale filter, or None if the source size is kept.
+        """
+        output_width, output_height = self.size(width, height)
+        if (output_width, output_height) == (width, height):
+            return None
+        return f'scale={output_width}:{output_height}'
+
+    def encoder_args(self, threads=None):
+        """
+        Get the ffmpeg video encoder arguments of the profile.
+
+        Args:
+            threads (int, optional): Encoder threads, overrides the threads of the profile.
+
+        Returns:
+            list: The arguments.
+        """
+        args = ['-c:v', 'libx264', '-preset', self.preset, '-crf', str(self.crf)]
+        threads = threads or self.threads
+        if threads:
+            args.extend(['-threads', str(threads)])
+        return args
+
+
+PROFILES = {
+    # quick drafts for editorial review
+    'preview': RenderProfile('preview', height=480, fps='24', preset='ultrafast', crf=30),
+    'standard': RenderProfile('standard'),
+    # final renders of approved scripts
+    'archive': RenderProfile('archive', preset='slow', crf=18),
+}
+
+
+def get_profile(profile=None):
+    """
+    Get a render profile by name.
+
+    Args:
+        profile (str or RenderProfile, optional): Name of the profile, or a profile. Defaults to RENDER_PROFILE.
+
+    Raises:
+        ValueError: If there is no profile with that name.
+
+    Returns:
+        RenderProfile: The profile.
+    """
+    if isinstance(profile, RenderProfile):
+        return profile
+    name = profile or RENDER_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f'Unknown render profile {name}, available profiles are {", ".join(PROFILES)}')
+    return PROFILES[name]
@@ -0,0 +1,277 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from log import logger
+import utils
+import subtitles
+from probe import probe, probe_many
+import effects
+from profiles import get_profile
+from metrics import run_ffmpeg
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '1'))
+
+
+def escape_filter_path(path):
+    """
+    Escape a file path so it can be used as an argument inside an ffmpeg filter graph.
+
+    Args:
+        path (str): The path to escape.
+
+    Returns:
+        str: The escaped path.
+    """
+    return path.replace('\\', '/').replace(':', '\\:').replace("'", "\\'")
+
+def effect_filters(chain, fx, next_input, video_path=None, start=0, srt_file=None, fps=None, profile=None):
+    """
+    Fuse the downscale of the profile, the effects and the subtitle burn-in into a filter chain.
+
+    Args:
+        chain (str): The filter chain so far, starting with its input label.
+        fx (list): Names of the registered effects to apply, in order.
+        next_input (int): Index of the next ffmpeg input, for inputs added by the effects.
+        video_path (str, optional): A video of the timeline, probed for its resolution when there are
+            effects or the profile downscales.
+        start (float): Position of the chain in the timeline, in seconds.
+        srt_file (str, optional): Path to the SRT subtitles to burn into the video.
+        fps (str, optional): Frames per second for the output video. Defaults to the frame rate of the profile.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
+
+    Returns:
+        tuple: The filters, the last one labelled [outv], and the extra ffmpeg input arguments.
+    """
+    profile = get_profile(profile)
+    fps = fps or profile.fps
+    width = height = scale = None
+    if fx or profile.height:
+        info = probe(video_path)
+        scale = profile.scale_filter(info.width, info.height)
+        width, height = profile.size(info.width, info.height)
+
+    effect_chain = effects.EffectChain(chain, next_input, width, height, start=start)
+    if scale:
+        # downscale before the effects and subtitles so they run on the smaller frames
+        effect_chain.add(scale)
+    effects.fuse(effect_chain, fx)
+
+    if srt_file:
+        effect_chain.add(f"subtitles='{escape_filter_path(srt_file)}'")
+
+    effect_chain.add(f"fps={fps},format=yuv420p")
+    effect_chain.close("[outv]")
+    return effect_chain.filters, effect_chain.inputs
+
+def build_command(video_paths, audio, output_file, fx=None, srt_file=None, fps=None, concat_list=None, profile=None):
+    """
+    Compile the whole render pipeline into a single ffmpeg command.
+
+    The clips are concatenated, trimmed to the audio length, filtered with the
+    requested effects, burned with subtitles and muxed with the audio inside one
+    -filter_complex graph, so the video is decoded and encoded only once.
+
+    Args:
+        video_paths (list): List of paths to input video files.
+        audio (str): Path to the input audio file.
+        output_file (str): Path to the output video file.
+        fx (list, optional): Names of the registered effects to apply, in order.
+        srt_file (str, optional): Path to the SRT subtitles to burn into the video.
+        fps (str, optional): Frames per second for the output video. Defaults to the frame rate of the profile.
+        concat_list (str, optional): Concat demuxer list of the videos, used as a single input
+            instead of decoding every video separately through the concat filter. video_paths
+            must then be the paths it lists, as the first one sizes the effects.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
+
+    Returns:
+        list: The ffmpeg command.
+    """
+    if not video_paths:
+        raise ValueError('At least one video is required to render')
+
+    fx = fx or []
+    profile = get_profile(profile)
+    fps = fps or profile.fps
+    min_duration = probe(audio).duration + 2
+
+    command = ['ffmpeg', '-y']
+    if concat_list:
+        command.extend(['-f', 'concat', '-safe', '0', '-i', concat_list])
+        chain = "[0:v]"
+        audio_index = 1
+    else:
+        for path in video_paths:
+            command.extend(['-i', path])
+        chain = "".join([f"[{i}:v]" for i in range(len(video_paths))])
+        chain += f"concat=n={len(video_paths)}:v=1:a=0,"
+        audio_index = len(video_paths)
+    command.extend(['-i', audio])
+
+    chain += f"fps={fps},trim=0:{min_duration},setpts=PTS-STARTPTS"
+    filters, inputs = effect_filters(chain, fx, audio_index + 1, video_path=video_paths[0], srt_file=srt_file, fps=fps,
+                                     profile=profile)
+    command.extend(inputs)
+    filters.append(f"[{audio_index}:a]atrim=0:{min_duration},asetpts=PTS-STARTPTS[outa]")
+
+    command.extend(['-filter_complex', ';'.join(filters)])
+    command.extend(['-map', '[outv]', '-map', '[outa]'] + profile.encoder_args() +
+                   ['-movflags', '+faststart', output_file])
+    return command
+
+def build_segment_command(video_path, output_file, start, duration, fx=None, srt_file=None, fps=None, threads=None,
+                          profile=None):
+    """
+    Compile the ffmpeg command rendering one segment of the timeline, without audio.
+
+    Args:
+        video_path (str): Path to the clip of the segment.
+        output_file (str): Path to the rendered segment.
+        start (float): Start of the segment in the timeline, in seconds.
+        duration (float): Duration of the segment in seconds.
+        fx (list, optional): Names of the registered effects to apply, in order.
+        srt_file (str, optional): Path to the SRT subtitles of the segment, starting at zero.
+        fps (str, optional): Frames per second for the output video. Defaults to the frame rate of the profile.
+        threads (int, optional): Number of encoder threads, overrides the threads of the profile.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
+
+    Returns:
+        list: The ffmpeg command.
+    """
+    fx = fx or []
+    profile = get_profile(profile)
+    fps = fps or profile.fps
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', video_path]
+
+    chain = f"[0:v]fps={fps},trim=0:{duration},setpts=PTS-STARTPTS"
+    filters, inputs = effect_filters(chain, fx, 1, video_path=video_path, start=start, srt_file=srt_file, fps=fps,
+                                     profile=profile)
+    command.extend(inputs)
+
+    command.extend(['-filter_complex', ';'.join(filters), '-map', '[outv]', '-an', '-t', str(duration)] +
+                   profile.encoder_args(threads) + ['-video_track_timescale', '90000', output_file])
+    return command
+
+def _run(command, description, metrics=None):
+    try:
+        run_ffmpeg(command, metrics=metrics)
+    except ValueError as e:
+        raise ValueError(f'Error while rendering {description}: {e}')
+
+def render_segments(video_paths, audio, output_file, workspace, fx=None, srt_file=None, fps=None, workers=RENDER_WORKERS,
+                    metrics=None, profile=None):
+    """
+    Render the final short by rendering segments of the timeline in parallel.
+
+    The timeline is split at clip boundaries. Every segment gets the effects and its
+    own slice of the subtitles in a separate ffmpeg process, then the segments are
+    joined with a stream copy and the audio is muxed in.
+
+    Args:
+        video_paths (list): List of paths to input video files.
+        audio (str): Path to the input audio file.
+        output_file (str): Path to the output video file.
+        workspace (Workspace): Workspace of the job, holding the segments.
+        fx (list, optional): Names of the registered effects to apply, in order.
+        srt_file (str, optional): Path to the SRT subtitles to burn into the video.
+        fps (str, optional): Frames per second for the output video. Defaults to the frame rate of the profile.
+        workers (int): Number of segments rendered at the same time.
+        metrics (StageMetrics, optional): Stage that receives the ffmpeg measurements.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
+
+    Returns:
+        str: Path to the rendered video.
+    """
+    profile = get_profile(profile)
+    segment_folder = workspace.path('segments/')
+    clips = utils.normalize_videos(video_paths, segment_folder, profile=profile)
+    total_duration = probe(audio).duration + 2
+    cues = subtitles.read_srt(srt_file) if srt_file else []
+    threads = profile.threads or max(1, (os.cpu_count() or 1) // workers)
+
+    segments = []
+    start = 0
+    for i, (clip, info) in enumerate(zip(clips, probe_many(clips))):
+        if start >= total_duration:
+            break
+        duration = min(info.duration, total_duration - start)
+        segment_srt = None
+        segment_cues = subtitles.slice_cues(cues, start, start + duration) if cues else None
+        if segment_cues:
+            segment_srt = subtitles.write_srt(segment_cues, os.path.join(segment_folder, f'segment-{i}.srt'))
+        segment_file = os.path.join(segment_folder, f'segment-{i}.mp4')
+        segments.append((segment_file, build_segment_command(clip, segment_file, start, duration, fx=fx,
+                                                             srt_file=segment_srt, fps=fps, threads=threads,
+                                                             profile=profile)))
+        start += duration
+
+    logger.info(f'Rendering {len(segments)} segments with {workers} workers, please wait...')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run, command, segment_file, metrics) for segment_file, command in segments]
+        for future in futures:
+            future.result()
+
+    list_file = utils.write_concat_list([segment_file for segment_file, _ in segments],
+                                        os.path.join(segment_folder, 'segments.txt'))
+    _run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_file, '-i', audio,
+          '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-c:a', 'aac',
+          '-t', str(total_duration), '-movflags', '+faststart', output_file], output_file, metrics)
+    return output_file
+
+def render(video_paths, audio, output_file, fx=None, srt_file=None, fps=None, workspace=None, workers=RENDER_WORKERS,
+           metrics=None, profile=None):
+    """
+    Render the final short with a single ffmpeg process.
+
+    When a workspace is given the videos are read through the concat demuxer, after
+    normalizing only the ones whose stream parameters differ from the others. With
+    more than one worker the segments of the timeline are rendered in parallel instead.
+
+    Args:
+        video_paths (list): List of paths to input video files.
+        audio (str): Path to the input audio file.
+        output_file (str): Path to the output video file.
+        fx (list, optional): Names of the registered effects to apply, in order.
+        srt_file (str, optional): Path to the SRT subtitles to burn into the video.
+        fps (str, optional): Frames per second for the output video. Defaults to the frame rate of the profile.
+        workspace (Workspace, optional): Workspace of the job, holding the intermediate files.
+        workers (int): Number of segments rendered at the same time, needs a workspace.
+        metrics (StageMetrics, optional): Stage that receives the ffmpeg measurements.
+        profile (str or RenderProfile, optional): Render profile, see profiles.PROFILES. Defaults to RENDER_PROFILE.
+
+    Raises:
+        ValueError: If ffmpeg fails to render the video.
+
+    Returns:
+        str: Path to the rendered video.
+    """
+    try:
+        profile = get_profile(profile)
+        if metrics is not None:
+            metrics.set('target_seconds', round(probe(audio).duration + 2, 3))
+        if workspace is not None and workers > 1 and len(video_paths) > 1:
+            render_segments(video_paths, audio, output_file, workspace, fx=fx, srt_file=srt_file, fps=fps,
+                            workers=workers, metrics=metrics, profile=profile)
+            logger.info(f'Video successfully rendered output => {output_file}')
+            return output_file
+
+        logger.info(f'Rendering {profile.name} video in a single pass, please wait...')
+        concat_list = None
+        if workspace is not None:
+            try:
+                # the demuxer reads the normalized clips, so the effects are sized from those
+                concat_list, video_paths = utils.prepare_concat(video_paths, workspace.path('concat/'),
+                                                                profile=profile)
+            except Exception as e:
+                logger.warning(f'Falling back to the concat filter: {e}')
+
+        command = build_command(video_paths, audio, output_file, fx=fx, srt_file=srt_file, fps=fps,
+                                concat_list=concat_list, profile=profile)
+        _run(command, output_file, metrics)
+        logger.info(f'Video successfully rendered output => {output_file}')
+        return output_file
+    except Exception as e:
+        logger.error(f'Unable to render {output_file}: {e}')
+        raise e
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from log import logger
+import tts
+from batch import BatchRunner, parse_job
+from metrics import JobMetrics
+from profiles import PROFILES, RENDER_PROFILE
+from workspace import TMP_FOLDER, WORKSPACE_RAM
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '8080'))
+OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER', 'out/')
+JOB_HISTORY = 1000
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the job queue is full.
+    """
+
+
+class JobServer:
+    """
+    Long-running service rendering shorts submitted as jobs.
+
+    Jobs wait in a bounded queue and are picked up by a fixed number of job workers.
+    The stages of all the jobs share the pools of a BatchRunner, which cap the encode,
+    network, speech and subtitle work running at the same time, and the models stay
+    loaded in the process between jobs.
+    """
+
+    def __init__(self, runner, workers=2, queue_size=16, output_folder=OUTPUT_FOLDER, history=JOB_HISTORY):
+        """
+        Args:
+            runner (BatchRunner): Runner holding the stage pools.
+            workers (int): Number of jobs running at the same time.
+            queue_size (int): Maximum number of jobs waiting for a worker.
+            output_folder (str): Folder receiving the rendered videos.
+            history (int): Number of finished jobs kept for status requests.
+        """
+        self.runner = runner
+        self.output_folder = output_folder
+        self.history = history
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(output_folder, exist_ok=True)
+        self.workers = [threading.Thread(target=self._work, name=f'job-{i}', daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, row):
+        """
+        Validate a job and queue it.
+
+        Args:
+            row (dict): The job with 'text', 'topic' and optional 'effects', 'profile' and 'output' file name.
+
+        Raises:
+            ValueError: If the job is invalid.
+            QueueFull: If the queue is full.
+
+        Returns:
+            dict: The status of the job.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        if row.get('output') is not None and not isinstance(row['output'], str):
+            raise ValueError('The output must be a file name')
+        # only the file name is used, every video is written to the output folder
+        output = os.path.basename(row.get('output') or '') or f'{job_id}.mp4'
+        fields = dict(row, output=os.path.join(self.output_folder, output))
+        # jobs come from the network, so they cannot read local text files
+        fields.pop('input', None)
+        job = parse_job(fields)
+        record = {'id': job_id, 'status': 'queued', 'output': job['output'], 'error': None,
+                  'submitted': time.time(), 'started': None, 'finished': None,
+                  'progress': None, 'metrics': None}
+        with self._lock:
+            self.jobs[job_id] = record
+            try:
+                self.queue.put_nowait((record, job))
+            except queue.Full:
+                del self.jobs[job_id]
+                raise QueueFull(f'The job queue is full ({self.queue.maxsize} jobs)')
+        logger.info(f'Job {job_id} queued for {job["output"]}')
+        return self.status(job_id)
+
+    def status(self, job_id):
+        """
+        Get the status of a job.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            dict: The status, progress and stage measurements of the job, or None if it is unknown.
+        """
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            status = {key: value for key, value in record.items() if key != 'metrics'}
+        if record['metrics'] is not None:
+            status['stages'] = record['metrics'].to_dict()['stages']
+        return status
+
+    def list(self):
+        """
+        Get the status of every known job.
+
+        Returns:
+            list: The statuses, oldest first, without the stage measurements.
+        """
+        with self._lock:
+            return [{key: record[key] for key in ('id', 'status', 'output', 'progress', 'error')}
+                    for record in self.jobs.values()]
+
+    def _listener(self, record):
+        def listener(stage, block):
+            target = stage.values.get('target_seconds')
+            encoded = stage.values.get('encoded_seconds', 0)
+            record['progress'] = {
+                'stage': stage.name,
+                'encoded_seconds': encoded,
+                'target_seconds': target,
+                'percent': round(min(100.0, 100 * encoded / target), 1) if target else None,
+                'fps': block.get('fps'),
+                'speed': block.get('speed'),
+            }
+        return listener
+
+    def _work(self):
+        while True:
+            record, job = self.queue.get()
+            record['metrics'] = JobMetrics(listener=self._listener(record))
+            record['status'] = 'running'
+            record['started'] = time.time()
+            try:
+                self.runner.run_job(job, metrics=record['metrics'])
+                record['status'] = 'done'
+            except Exception as e:
+                logger.error(f'Job {record["id"]} failed: {e}')
+                record['status'] = 'failed'
+                record['error'] = str(e)
+            finally:
+                record['finished'] = time.time()
+                self.queue.task_done()
+                self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, record in self.jobs.items() if record['finished']]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job_id]
+
+
+class _JobHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            self._send_json({'jobs': self.server.jobs.list()})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            status = self.server.jobs.status(parts[1])
+            if status is None:
+                self._send_json({'error': f'Unknown job {parts[1]}'}, status=404)
+            else:
+                self._send_json(status)
+        else:
+            self._send_json({'error': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            self._send_json({'error': 'Not Found'}, status=404)
+            return
+        try:
+            row = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(row, dict):
+                raise ValueError('The job must be a JSON object')
+            self._send_json(self.server.jobs.submit(row), status=202)
+        except QueueFull as e:
+            self._send_json({'error': str(e)}, status=503)
+        except ValueError as e:
+            self._send_json({'error': str(e)}, status=400)
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=2, queue_size=16, encode_slots=2, network_slots=4,
+          tts_workers=1, subtitle_workers=1, output_folder=OUTPUT_FOLDER, preload=False, profile=RENDER_PROFILE):
+    """
+    Run the render service.
+
+    POST /jobs with a JSON job ({"text", "topic", "effects", "profile", "output"}) queues it
+    and answers with its ID, GET /jobs/{id} returns its status, render progress and stage
+    measurements, and GET /jobs lists every known job.
+
+    Parameters:
+    - host (str): Address to listen on.
+    - port (int): Port to listen on.
+    - workers (int): Number of jobs running at the same time.
+    - queue_size (int): Maximum number of jobs waiting for a worker.
+    - encode_slots (int): Number of ffmpeg encodes (merge and render stages) running at the same time.
+    - network_slots (int): Number of jobs searching and downloading footage at the same time.
+    - tts_workers (int): Number of jobs synthesizing speech at the same time.
+    - subtitle_workers (int): Number of jobs generating subtitles at the same time.
+    - output_folder (str): Folder receiving the rendered videos.
+    - preload (bool): Load the TTS model before accepting jobs.
+    - profile (str): Render profile of the jobs that do not set one.
+
+    Returns:
+    None
+    """
+    if preload:
+        tts.get_engine()
+    runner = BatchRunner(tts_workers=tts_workers, download_workers=network_slots, subtitle_workers=subtitle_workers,
+                         render_workers=encode_slots, tmp_folder=TMP_FOLDER, ram=WORKSPACE_RAM, profile=profile)
+    server = ThreadingHTTPServer((host, port), _JobHandler)
+    server.daemon_threads = True
+    server.jobs = JobServer(runner, workers=workers, queue_size=queue_size, output_folder=output_folder)
+    logger.info(f'Render service listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        runner.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a render service with an HTTP job API.")
+    parser.add_argument("--host", dest="host", default=SERVER_HOST, help="Address to listen on")
+    parser.add_argument("--port", dest="port", type=int, default=SERVER_PORT, help="Port to listen on")
+    parser.add_argument("--workers", dest="workers", type=int, default=2, help="Concurrent jobs")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=16, help="Maximum queued jobs")
+    parser.add_argument("--encode-slots", dest="encode_slots", type=int, default=2, help="Concurrent ffmpeg encodes")
+    parser.add_argument("--network-slots", dest="network_slots", type=int, default=4, help="Concurrent footage downloads")
+    parser.add_argument("--tts-workers", dest="tts_workers", type=int, default=1, help="Concurrent speech synthesis jobs")
+    parser.add_argument("--subtitle-workers", dest="subtitle_workers", type=int, default=1, help="Concurrent subtitle jobs")
+    parser.add_argument("--output-folder", dest="output_folder", default=OUTPUT_FOLDER, help="Folder for the rendered videos")
+    parser.add_argument("--preload", dest="preload", action="store_true", help="Load the TTS model on start")
+    parser.add_argument("--profile", dest="profile", choices=list(PROFILES), default=RENDER_PROFILE,
+                        help="Render profile of the jobs that do not set one")
+    args = parser.parse_args()
+
+    serve(host=args.host, port=args.port, workers=args.workers, queue_size=args.queue_size,
+          encode_slots=args.encode_slots, network_slots=args.network_slots, tts_workers=args.tts_workers,
+          subtitle_workers=args.subtitle_workers, output_folder=args.output_folder, preload=args.preload,
+          profile=args.profile)
@@ -1,67 +1,160 @@
 import os
 import argparse
-from venv import logger
+from concurrent.futures import Future
 import pexels
 import utils
+import render
 import effects
+import subtitles
+import tts
+from log import logger
+from pipeline import Pipeline, PIPELINE_CACHE_FOLDER, link_or_copy
+from probe import probe
+from profiles import PROFILES, RENDER_PROFILE, get_profile
+from workspace import Workspace, WORKSPACE_RAM
 from dotenv import load_dotenv, find_dotenv
 
 
 load_dotenv(find_dotenv())
 
-PEXELS_FOLDER = os.environ.get('PEXELS_FOLDER')
-TMP_FOLDER = os.environ.get('TMP_FOLDER')
 
+def build_pipeline(input_text, topic, fx, profile, workspace, cache_folder=PIPELINE_CACHE_FOLDER, executors=None):
+    """
+    Describe the stages of a short as a cached pipeline.
+
+    The speech, footage, subtitles and normalized clips are each kept in the stage
+    cache, so changing the effects only renders again and a failed job resumes from
+    its last completed stage. The rendered video is written to the workspace instead,
+    as it is moved out of it anyway.
+
+    Parameters:
+    - input_text (str): Input text for the video.
+    - topic (str): Topic for the video.
+    - fx (list): Names of the registered effects to apply to the video, in order.
+    - profile (RenderProfile): Render profile.
+    - workspace (Workspace): Workspace of the job, for the rendered video and the temporary files of the render.
+    - cache_folder (str): Folder of the stage cache.
+    - executors (dict): Executor running each stage, by stage name. Stages without one run in their own thread.
+
+    Returns:
+    Pipeline: The pipeline, with the rendered video as output of its 'render' stage.
+    """
+    executors = executors or {}
+    pipeline = Pipeline(cache_folder, metrics=workspace.metrics, work_folder=workspace.path('stages/'))
+
+    def synthesize(folder, metrics=None):
+        audio_file = os.path.join(folder, 't2s.wav')
+        utils.text_to_speech(input_text, audio_file, speaker=tts.DEFAULT_SPEAKER)
+        return [audio_file, subtitles.timings_path(audio_file)]
+
+    def download(folder, metrics=None):
+        # search and download start with the speech, planned from an estimate of its duration
+        duration = Future()
+
+        def speech_done(future):
+            try:
+                duration.set_result(probe(future.result()[0]).duration)
+            except Exception as e:
+                duration.set_exception(e)
+
+        pipeline.future('tts').add_done_callback(speech_done)
+        stage_workspace = Workspace(root=folder, metrics=workspace.metrics)
+        return pexels.download_videos(topic, stage_workspace, total_pages=1, duration=duration,
+                                      estimate=tts.estimate_duration(input_text))
+
+    def transcribe(folder, speech, metrics=None):
+        srt_file = os.path.join(folder, 'sub.srt')
+        utils.generate_srt(speech[0], srt_file)
+        return [srt_file]
+
+    def merge(folder, clips, metrics=None):
+        normalized = utils.normalize_videos(clips, folder, profile=profile)
+        # clips that are already joinable are linked so the stage owns all of its outputs
+        return [path if path.startswith(folder) else link_or_copy(path, os.path.join(folder, f'clip-{i}.mp4'))
+                for i, path in enumerate(normalized)]
+
+    def render_video(folder, speech, srt, clips, metrics=None):
+        # concat, effects, audio and subtitles are rendered in a single ffmpeg pass
+        return [render.render(clips, speech[0], os.path.join(folder, 'video.mp4'), fx=fx, srt_file=srt[0],
+                              workspace=workspace, metrics=metrics, profile=profile)]
+
+    pipeline.add('tts', synthesize, {'text': input_text, 'speaker': tts.DEFAULT_SPEAKER, 'model': tts.MODEL_NAME},
+                 executor=executors.get('tts'))
+    # footage waits for the speech itself, so it depends on the text instead of the tts stage
+    pipeline.add('footage', download, {'topic': topic, 'quality': 'hd', 'text': input_text},
+                 executor=executors.get('footage'))
+    pipeline.add('srt', transcribe, {'words_per_cue': subtitles.WORDS_PER_CUE}, inputs=('tts',),
+                 executor=executors.get('srt'))
+    pipeline.add('merge', merge, {'preset': profile.preset, 'crf': profile.crf}, inputs=('footage',),
+                 executor=executors.get('merge'))
+    pipeline.add('render', render_video, {'fx': fx or [], 'profile': vars(profile)}, inputs=('tts', 'srt', 'merge'),
+                 executor=executors.get('render'), cache=False)
+    return pipeline
+
+def save_output(video_file, output_file):
+    """
+    Move a rendered video out of the workspace.
+
+    The video is hard linked when the workspace is on the same file system as the output,
+    and copied otherwise, e.g. from the RAM disk.
+
+    Parameters:
+    - video_file (str): Path of the rendered video in the workspace.
+    - output_file (str): Path of the generated video.
+
+    Returns:
+    str: The output path.
+    """
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    return link_or_copy(video_file, output_file)
 
-def main(input_text=None, topic=None, fx=None):
+def main(input_text=None, topic=None, fx=None, output_file='video.mp4', ram=WORKSPACE_RAM, report=None,
+         prometheus=None, profile=None):
     """
     Main function to generate a short video based on input text and topic.
 
     Parameters:
     - input_text (str): Input text for the video.
     - topic (str): Topic for the video.
-    - fx (list): List of effects to apply to the video.
+    - fx (list): Names of the registered effects to apply to the video, in order.
+    - output_file (str): Path of the generated video.
+    - ram (bool): Keep the intermediate files on the RAM disk.
+    - report (str): Path of a JSON report with the timings and resources of every stage.
+    - prometheus (str): Path of a Prometheus text file with the same measurements.
+    - profile (str): Render profile, 'preview', 'standard' or 'archive'. Defaults to RENDER_PROFILE.
 
     Returns:
     None
     """
+    effects.get_effects(fx or [])
+    profile = get_profile(profile)
+    workspace = Workspace(ram=ram)
+    metrics = workspace.metrics
     try:
-        utils.create_folder(PEXELS_FOLDER)
-        utils.text_to_speech(input_text, f'{TMP_FOLDER}t2s.wav')
-        pexels.download_videos(topic, output_folder=PEXELS_FOLDER, total_pages=1)
-
-        video_paths = [os.path.join(PEXELS_FOLDER, file) for file in os.listdir(PEXELS_FOLDER)]
-        utils.merge_videos(video_paths, output_file=f'{TMP_FOLDER}merged.mp4')
-        
-        if fx:
-            # apply effects if any after merging videos
-            if 'vintage' in fx and 'grayscale' in fx:
-                effects.vintage(f'{TMP_FOLDER}merged.mp4', f'{TMP_FOLDER}vintage.mp4')
-                effects.grayscale(f'{TMP_FOLDER}vintage.mp4', f'{TMP_FOLDER}effects.mp4')
-            else:
-                if 'grayscale' in fx:
-                    effects.grayscale(f'{TMP_FOLDER}merged.mp4', f'{TMP_FOLDER}effects.mp4')
-                elif 'vintage' in fx:
-                    effects.vintage(f'{TMP_FOLDER}merged.mp4', f'{TMP_FOLDER}effects.mp4')
-            #
-            utils.audio_into_video(f'{TMP_FOLDER}effects.mp4', f'{TMP_FOLDER}t2s.wav', output_file=f'{TMP_FOLDER}merged_and_audio.mp4')
-        else:
-            utils.audio_into_video(f'{TMP_FOLDER}merged.mp4', f'{TMP_FOLDER}t2s.wav', output_file=f'{TMP_FOLDER}merged_and_audio.mp4')
-               
-        utils.generate_srt(f'{TMP_FOLDER}t2s.wav', f'{TMP_FOLDER}sub.srt')
-        utils.embed_srt_into_video(f'{TMP_FOLDER}merged_and_audio.mp4', f'{TMP_FOLDER}sub.srt', 'video.mp4')
-    except Exception as e:
-        utils.clean_up()
-        raise e
+        outputs = build_pipeline(input_text, topic, fx, profile, workspace).run()
+        save_output(outputs['render'][0], output_file)
+        logger.info(f'Short saved to {output_file}')
     finally:
-        utils.clean_up()
+        if report:
+            metrics.write_report(report)
+        if prometheus:
+            metrics.write_prometheus(prometheus)
+        utils.clean_up(workspace)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Generate a short video based on input text and topic.")
     parser.add_argument("-i", "--input", dest="input_text", required=True, help="Input text file for the video")
     parser.add_argument("-t", "--topic", dest="topic", required=True, help="Topic for the video")
-    parser.add_argument("-fx", "--effects", dest="fx", help="List of effects to apply to the video")
+    parser.add_argument("-fx", "--effects", dest="fx", help=f"List of effects to apply to the video ({', '.join(sorted(effects.EFFECTS))})")
+    parser.add_argument("-o", "--output", dest="output_file", default="video.mp4", help="Output video file")
+    parser.add_argument("--ram", dest="ram", action="store_true", default=WORKSPACE_RAM, help="Keep intermediate files on the RAM disk")
+    parser.add_argument("--profile", dest="profile", choices=list(PROFILES), default=RENDER_PROFILE,
+                        help="Render profile, preview renders a fast low resolution draft")
+    parser.add_argument("--report", dest="report", help="Write the timings and resources of every stage to a JSON file")
+    parser.add_argument("--prometheus", dest="prometheus", help="Write the stage measurements to a Prometheus text file")
     args = parser.parse_args()
 
     # Read input text file
@@ -69,4 +162,5 @@ if __name__ == '__main__':
         input_text_content = file.read()
     
     fxs = args.fx.strip().split(',') if args.fx else None
-    main(input_text=input_text_content, topic=args.topic, fx=fxs)
+    main(input_text=input_text_content, topic=args.topic, fx=fxs, output_file=args.output_file, ram=args.ram,
+         report=args.report, prometheus=args.prometheus, profile=args.profile)
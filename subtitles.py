@@ -0,0 +1,185 @@
+import re
+import json
+
+TIMESTAMP_PATTERN = re.compile(r'(\d+):(\d+):(\d+)[,.](\d+)')
+TIMINGS_SUFFIX = '.timings.json'
+WORDS_PER_CUE = 7
+
+
+def parse_timestamp(timestamp):
+    """
+    Convert an SRT timestamp to seconds.
+
+    Args:
+        timestamp (str): Timestamp formatted as HH:MM:SS,mmm.
+
+    Returns:
+        float: The timestamp in seconds.
+    """
+    hours, minutes, seconds, millis = TIMESTAMP_PATTERN.match(timestamp.strip()).groups()
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+
+def format_timestamp(seconds):
+    """
+    Convert seconds to an SRT timestamp.
+
+    Args:
+        seconds (float): The time in seconds.
+
+    Returns:
+        str: Timestamp formatted as HH:MM:SS,mmm.
+    """
+    millis = max(0, int(round(seconds * 1000)))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    seconds, millis = divmod(millis, 1000)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d},{millis:03d}'
+
+def read_srt(srt_file):
+    """
+    Read the cues of an SRT file.
+
+    Args:
+        srt_file (str): Path to the SRT file.
+
+    Returns:
+        list: Cues as (start, end, text) tuples, times in seconds.
+    """
+    with open(srt_file, 'r') as file:
+        blocks = re.split(r'\n\s*\n', file.read().strip())
+
+    cues = []
+    for block in blocks:
+        lines = block.strip().splitlines()
+        timing = next((i for i, line in enumerate(lines) if '-->' in line), None)
+        if timing is None:
+            continue
+        start, end = lines[timing].split('-->')
+        cues.append((parse_timestamp(start), parse_timestamp(end), '\n'.join(lines[timing + 1:])))
+    return cues
+
+def format_cue(number, cue):
+    """
+    Format a single cue as an SRT block.
+
+    Args:
+        number (int): The number of the cue, starting at 1.
+        cue (tuple): The cue as (start, end, text), times in seconds.
+
+    Returns:
+        str: The SRT block, ending with a blank line.
+    """
+    start, end, text = cue
+    return f'{number}\n{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n'
+
+def format_srt(cues):
+    """
+    Format cues as SRT text.
+
+    Args:
+        cues (list): Cues as (start, end, text) tuples, times in seconds.
+
+    Returns:
+        str: The SRT content.
+    """
+    return ''.join(format_cue(number, cue) for number, cue in enumerate(cues, start=1))
+
+def write_srt(cues, output_file):
+    """
+    Write cues to an SRT file.
+
+    Args:
+        cues (list): Cues as (start, end, text) tuples, times in seconds.
+        output_file (str): Path to the SRT file.
+
+    Returns:
+        str: Path to the SRT file.
+    """
+    with open(output_file, 'w') as file:
+        file.write(format_srt(cues))
+    return output_file
+
+def slice_cues(cues, start, end):
+    """
+    Keep the cues shown between two times, shifted so that start becomes zero.
+
+    Args:
+        cues (list): Cues as (start, end, text) tuples, times in seconds.
+        start (float): Start of the slice in seconds.
+        end (float): End of the slice in seconds.
+
+    Returns:
+        list: The shifted cues, clipped to the slice.
+    """
+    return [(max(cue_start, start) - start, min(cue_end, end) - start, text)
+            for cue_start, cue_end, text in cues
+            if cue_end > start and cue_start < end]
+
+def timings_path(audio_file):
+    """
+    Get the path of the sidecar file holding the speech timings of an audio file.
+
+    Args:
+        audio_file (str): Path to the audio file.
+
+    Returns:
+        str: Path of the timings file.
+    """
+    return audio_file + TIMINGS_SUFFIX
+
+def write_timings(segments, audio_file):
+    """
+    Save the speech segments captured during synthesis next to the audio file.
+
+    Args:
+        segments (list): Segments as (start, end, text) tuples, times in seconds.
+        audio_file (str): Path to the audio file.
+
+    Returns:
+        str: Path of the timings file.
+    """
+    with open(timings_path(audio_file), 'w') as file:
+        json.dump([list(segment) for segment in segments], file)
+    return timings_path(audio_file)
+
+def read_timings(audio_file):
+    """
+    Read the speech segments saved next to an audio file.
+
+    Args:
+        audio_file (str): Path to the audio file.
+
+    Returns:
+        list: Segments as (start, end, text) tuples, or None if there are no timings.
+    """
+    try:
+        with open(timings_path(audio_file), 'r') as file:
+            return [tuple(segment) for segment in json.load(file)]
+    except FileNotFoundError:
+        return None
+
+def cues_from_segments(segments, words_per_cue=WORDS_PER_CUE):
+    """
+    Build subtitle cues from the known text and timings of the speech.
+
+    Every segment is split into lines of words_per_cue words, and the duration of
+    the segment is shared between its lines in proportion to their length.
+
+    Args:
+        segments (list): Segments as (start, end, text) tuples, times in seconds.
+        words_per_cue (int): Maximum number of words in a cue.
+
+    Returns:
+        list: Cues as (start, end, text) tuples, times in seconds.
+    """
+    cues = []
+    for start, end, text in segments:
+        words = text.split()
+        lines = [' '.join(words[i:i + words_per_cue]) for i in range(0, len(words), words_per_cue)]
+        total_length = sum(len(line) for line in lines) or 1
+        position = start
+        for line in lines:
+            line_end = position + (end - start) * len(line) / total_length
+            cues.append((position, line_end, line))
+            position = line_end
+    return cues
@@ -0,0 +1,213 @@
+import os
+import time
+import pytest
+import effects
+import planner
+import subtitles
+import utils
+from pipeline import Pipeline, MANIFEST
+
+
+def write_stage(name, calls):
+    """
+    Make a stage function writing one file and counting its calls.
+    """
+    def run(folder, *inputs, metrics=None):
+        calls.append(name)
+        path = os.path.join(folder, f'{name}.txt')
+        with open(path, 'w') as file:
+            file.write('+'.join([name] + [open(files[0]).read() for files in inputs]))
+        return [path]
+    return run
+
+def make_pipeline(tmp_path, calls, params=None):
+    params = params or {}
+    pipeline = Pipeline(str(tmp_path / 'cache'), work_folder=str(tmp_path / 'work'))
+    pipeline.add('a', write_stage('a', calls), params.get('a'))
+    pipeline.add('b', write_stage('b', calls), params.get('b'), inputs=('a',))
+    pipeline.add('c', write_stage('c', calls), params.get('c'))
+    return pipeline
+
+
+def test_key_depends_on_params_and_upstream(tmp_path):
+    base = make_pipeline(tmp_path, [])
+    same = make_pipeline(tmp_path, [])
+    upstream = make_pipeline(tmp_path, [], {'a': {'x': 1}})
+    downstream = make_pipeline(tmp_path, [], {'b': {'x': 1}})
+
+    assert [base.key(name) for name in 'abc'] == [same.key(name) for name in 'abc']
+    assert upstream.key('a') != base.key('a')
+    assert upstream.key('b') != base.key('b')
+    assert upstream.key('c') == base.key('c')
+    assert downstream.key('a') == base.key('a')
+    assert downstream.key('b') != base.key('b')
+
+def test_key_ignores_param_order(tmp_path):
+    first = make_pipeline(tmp_path, [], {'a': {'x': 1, 'y': 2}})
+    second = make_pipeline(tmp_path, [], {'a': {'y': 2, 'x': 1}})
+    assert first.key('a') == second.key('a')
+
+def test_outputs_are_reused(tmp_path):
+    calls = []
+    outputs = make_pipeline(tmp_path, calls).run()
+    assert sorted(calls) == ['a', 'b', 'c']
+    assert open(outputs['b'][0]).read() == 'b+a'
+
+    calls.clear()
+    assert make_pipeline(tmp_path, calls).run() == outputs
+    assert calls == []
+
+def test_only_changed_stages_run_again(tmp_path):
+    calls = []
+    make_pipeline(tmp_path, calls).run()
+    calls.clear()
+    make_pipeline(tmp_path, calls, {'b': {'x': 1}}).run()
+    assert calls == ['b']
+
+def test_failed_stage_resumes(tmp_path):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    pipeline.stages['b']['run'] = lambda folder, *inputs, metrics=None: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        pipeline.run()
+    assert not os.path.exists(pipeline.folder('b'))
+
+    calls.clear()
+    make_pipeline(tmp_path, calls).run()
+    assert calls == ['b']
+
+def test_uncached_stage_runs_every_time(tmp_path):
+    calls = []
+    for _ in range(2):
+        pipeline = make_pipeline(tmp_path, calls)
+        pipeline.add('d', write_stage('d', calls), inputs=('b',), cache=False)
+        outputs = pipeline.run()
+    assert calls.count('d') == 2
+    assert calls.count('b') == 1
+    assert outputs['d'][0].startswith(str(tmp_path / 'work'))
+    assert not os.path.exists(os.path.join(pipeline.cache_folder, 'd'))
+
+def test_uncached_stage_needs_work_folder(tmp_path):
+    pipeline = Pipeline(str(tmp_path / 'cache'))
+    with pytest.raises(ValueError):
+        pipeline.add('a', write_stage('a', []), cache=False)
+
+def test_outputs_outside_of_the_stage_folder_are_rejected(tmp_path):
+    pipeline = Pipeline(str(tmp_path / 'cache'))
+    outside = tmp_path / 'outside.txt'
+    outside.write_text('a')
+    pipeline.add('a', lambda folder, metrics=None: [str(outside)])
+    with pytest.raises(ValueError):
+        pipeline.run()
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    calls = []
+    pipeline = make_pipeline(tmp_path, calls)
+    pipeline.run()
+    now = time.time()
+    for age, name in ((300, 'a'), (200, 'c'), (100, 'b')):
+        os.utime(os.path.join(pipeline.folder(name), MANIFEST), (now - age, now - age))
+
+    folder = pipeline.folder('b')
+    size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+    assert pipeline.prune(max_size=size, min_age=50) == 2
+    assert not os.path.exists(pipeline.folder('a'))
+    assert not os.path.exists(pipeline.folder('c'))
+    assert os.path.exists(pipeline.folder('b'))
+
+def test_prune_counts_nested_outputs(tmp_path):
+    def footage(folder, metrics=None):
+        os.makedirs(os.path.join(folder, 'pexels'))
+        path = os.path.join(folder, 'pexels', '1.mp4')
+        with open(path, 'wb') as file:
+            file.write(b'0' * 10000)
+        return [path]
+
+    pipeline = Pipeline(str(tmp_path / 'cache'))
+    pipeline.add('footage', footage)
+    pipeline.run()
+    old = time.time() - 300
+    os.utime(os.path.join(pipeline.folder('footage'), MANIFEST), (old, old))
+
+    assert pipeline.prune(max_size=1000, min_age=50) == 1
+    assert not os.path.exists(pipeline.folder('footage'))
+
+def test_prune_keeps_recently_used_folders(tmp_path):
+    pipeline = make_pipeline(tmp_path, [])
+    pipeline.run()
+    assert pipeline.prune(max_size=0) == 0
+    assert all(os.path.exists(pipeline.folder(name)) for name in 'abc')
+
+
+def video(media_id, duration, width=1920):
+    return {'id': media_id, 'duration': duration, 'video_files': [{'width': width, 'link': f'{media_id}.mp4'}]}
+
+def test_plan_takes_longest_clips_and_the_shortest_fitting_last():
+    videos = [video(1, 30), video(2, 10), video(3, 6)]
+    plan = planner.plan_clips(videos, 19, max_clip_duration=15, margin=1, seed=0)
+    assert plan == [{'id': 1, 'duration': 15}, {'id': 3, 'duration': 5}]
+
+def test_plan_covers_target_with_margin():
+    videos = [video(i, 4 + i % 7) for i in range(40)]
+    plan = planner.plan_clips(videos, 42.5, margin=1, seed=3)
+    assert sum(entry['duration'] for entry in plan) == pytest.approx(43.5)
+    assert all(entry['duration'] <= planner.MAX_CLIP_DURATION for entry in plan)
+    assert len({entry['id'] for entry in plan}) == len(plan)
+
+def test_plan_skips_unusable_videos():
+    videos = [video(1, 20, width=1280), {'id': 2, 'duration': None, 'video_files': [{'width': 1920}]}, video(3, 5)]
+    assert planner.plan_clips(videos, 30, seed=0) == [{'id': 3, 'duration': 5}]
+
+def test_plan_is_reproducible_with_a_seed():
+    videos = [video(i, 8) for i in range(20)]
+    assert planner.plan_clips(videos, 30, seed=7) == planner.plan_clips(videos, 30, seed=7)
+
+
+def test_slice_cues_shifts_and_clips():
+    cues = [(0.0, 2.0, 'one'), (2.0, 5.0, 'two'), (5.0, 6.0, 'three'), (7.0, 8.0, 'four')]
+    assert subtitles.slice_cues(cues, 3.0, 6.5) == [(0.0, 2.0, 'two'), (2.0, 3.0, 'three')]
+    assert subtitles.slice_cues(cues, 6.0, 7.0) == []
+
+def test_cues_from_segments_splits_lines_by_length():
+    cues = subtitles.cues_from_segments([(1.0, 4.0, 'aa bb cc dddddd')], words_per_cue=3)
+    assert [text for _, _, text in cues] == ['aa bb cc', 'dddddd']
+    (first_start, first_end, _), (second_start, second_end, _) = cues
+    assert first_start == 1.0
+    assert first_end == pytest.approx(1.0 + 3.0 * 8 / 14)
+    assert second_start == first_end
+    assert second_end == pytest.approx(4.0)
+
+def test_cues_from_segments_keeps_segment_order():
+    cues = subtitles.cues_from_segments([(0.0, 1.0, 'first'), (1.5, 2.0, 'second')])
+    assert cues == [(0.0, 1.0, 'first'), (1.5, 2.0, 'second')]
+
+
+@pytest.fixture
+def fake_effects(monkeypatch):
+    def effect(name, fps=None, pix_fmt=None):
+        def build(chain):
+            chain.add(name)
+        monkeypatch.setitem(effects.EFFECTS, name, effects.Effect(name, build, fps=fps, pix_fmt=pix_fmt))
+
+    effect('slow', fps='10', pix_fmt='yuv420p')
+    effect('fast', fps='24', pix_fmt='yuv420p')
+    effect('rgb', pix_fmt='rgb24')
+    effect('plain')
+
+def test_fuse_keeps_effect_order(fake_effects):
+    chain = effects.fuse(effects.EffectChain('[0:v]', 1, 1920, 1080), ['plain', 'rgb', 'fast'])
+    assert chain.chain == '[0:v]fps=24,plain,format=rgb24,rgb,format=yuv420p,fast'
+
+def test_fuse_uses_the_lowest_rate_once_and_converts_only_when_needed(fake_effects):
+    chain = effects.fuse(effects.EffectChain('[0:v]', 1, 1920, 1080), ['fast', 'slow'])
+    assert chain.chain == '[0:v]fps=10,format=yuv420p,fast,slow'
+    assert chain.fps == '10'
+
+def test_fuse_rejects_unknown_effects(fake_effects):
+    with pytest.raises(ValueError):
+        effects.fuse(effects.EffectChain('[0:v]', 1, 1920, 1080), ['plain', 'missing'])
+
+
+def test_normalize_videos_needs_videos(tmp_path):
+    with pytest.raises(ValueError):
+        utils.normalize_videos([], str(tmp_path))
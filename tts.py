@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import wave
+import uuid
+import random
+import hashlib
+import multiprocessing
+import argparse
+import threading
+import socketserver
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from log import logger
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+MODEL_NAME = "tts_models/en/vctk/vits"
+DEFAULT_SPEAKER = 'p330'
+
+# Available speakers
+SPEAKERS = frozenset([
+    'ED', 'p225', 'p226', 'p227', 'p228', 'p229',
+    'p230', 'p231', 'p232', 'p233', 'p234', 'p236',
+    'p237', 'p238', 'p239', 'p240', 'p241', 'p243',
+    'p244', 'p245', 'p246', 'p247', 'p248', 'p249',
+    'p250', 'p251', 'p252', 'p253', 'p254', 'p255',
+    'p256', 'p257', 'p258', 'p259', 'p260', 'p261',
+    'p262', 'p263', 'p264', 'p265', 'p266', 'p267',
+    'p268', 'p269', 'p270', 'p271', 'p272', 'p273',
+    'p274', 'p275', 'p276', 'p277', 'p278', 'p279',
+    'p280', 'p281', 'p282', 'p283', 'p284', 'p285',
+    'p286', 'p287', 'p288', 'p292', 'p293', 'p294',
+    'p295', 'p297', 'p298', 'p299', 'p300', 'p301',
+    'p302', 'p303', 'p304', 'p305', 'p306', 'p307',
+    'p308', 'p310', 'p311', 'p312', 'p313', 'p314',
+    'p316', 'p317', 'p318', 'p323', 'p326', 'p329',
+    'p330', 'p333', 'p334', 'p335', 'p336', 'p339',
+    'p340', 'p341', 'p343', 'p345', 'p347', 'p351',
+    'p360', 'p361', 'p362', 'p363', 'p364', 'p374',
+    'p376',
+])
+
+TTS_SOCKET = os.environ.get('TTS_SOCKET')
+TTS_CACHE_FOLDER = os.environ.get('TTS_CACHE_FOLDER', 'cache/tts/')
+TTS_WORKERS = int(os.environ.get('TTS_WORKERS', '1'))
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+# Average speaking rate of the VITS voices, in words per second
+SPEECH_RATE = 2.5
+
+_engine = None
+_engine_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def resolve_speaker(speaker):
+    """
+    Pick a random speaker when none is given and validate the speaker identity.
+
+    Args:
+        speaker (str): Speaker identity, or None for a random one.
+
+    Raises:
+        ValueError: If the speaker is not available in the model.
+
+    Returns:
+        str: The speaker identity.
+    """
+    if not speaker:
+        return random.choice(sorted(SPEAKERS))
+    if speaker not in SPEAKERS:
+        raise ValueError(f'Speaker {speaker} is not available')
+    return speaker
+
+
+class SpeechEngine:
+    """
+    Long-lived text to speech engine that keeps the VITS model loaded.
+
+    torch and TTS are only imported when the first engine is created, so importing
+    this module stays cheap for processes that never synthesize speech.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, device=None):
+        import torch
+        from TTS.api import TTS
+
+        self.model_name = model_name
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info(f'Loading {model_name} on {self.device}')
+        self.tts = TTS(model_name=model_name, progress_bar=False).to(self.device)
+        self._lock = threading.Lock()
+
+    def synthesize(self, txt, output_file, speaker=DEFAULT_SPEAKER):
+        """
+        Convert text to speech and save it to a file.
+
+        Args:
+            txt (str): The text to convert.
+            output_file (str): The path to save the speech.
+            speaker (str, optional): Speaker identity. Defaults to 'p330'.
+
+        Returns:
+            str: The path to the speech file.
+        """
+        speaker = resolve_speaker(speaker)
+        with self._lock:
+            self.tts.tts_to_file(txt, file_path=output_file, speaker=speaker)
+        return output_file
+
+    def synthesize_batch(self, jobs):
+        """
+        Synthesize several jobs with the same loaded model.
+
+        Args:
+            jobs (list): List of dicts with 'text', 'output_file' and optional 'speaker' keys.
+
+        Returns:
+            list: The paths to the speech files, in the same order as the jobs.
+        """
+        return [self.synthesize(job['text'], job['output_file'], job.get('speaker', DEFAULT_SPEAKER))
+                for job in jobs]
+
+
+def get_engine():
+    """
+    Get the process wide speech engine, loading the model on first use.
+
+    Returns:
+        SpeechEngine: The shared engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = SpeechEngine()
+        return _engine
+
+def split_sentences(txt):
+    """
+    Split a text into sentences.
+
+    Args:
+        txt (str): The text to split.
+
+    Returns:
+        list: The non empty sentences.
+    """
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(txt) if sentence.strip()]
+
+def estimate_duration(txt, pause=0.2):
+    """
+    Estimate how long the speech of a text will last, before synthesizing it.
+
+    Args:
+        txt (str): The text.
+        pause (float): Seconds of silence between sentences, as in join_wavs.
+
+    Returns:
+        float: The estimated duration in seconds.
+    """
+    return len(txt.split()) / SPEECH_RATE + pause * max(0, len(split_sentences(txt)) - 1)
+
+def cache_path(sentence, speaker, model_name=MODEL_NAME, cache_folder=TTS_CACHE_FOLDER):
+    """
+    Get the content addressed cache path of a synthesized sentence.
+
+    Args:
+        sentence (str): The sentence text.
+        speaker (str): Speaker identity.
+        model_name (str): Name of the TTS model.
+        cache_folder (str): Folder holding the cached sentences.
+
+    Returns:
+        str: Path of the cached wav file.
+    """
+    key = hashlib.sha256(json.dumps([sentence, speaker, model_name]).encode()).hexdigest()
+    return os.path.join(cache_folder, key[:2], f'{key}.wav')
+
+def _init_pool_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+    get_engine()
+
+def _synthesize_sentence(sentence, speaker, output_file):
+    # write next to the target and rename so concurrent jobs never read a partial file,
+    # unique per call as jobs running as threads of one process may synthesize the same sentence
+    tmp_file = f'{output_file}.{uuid.uuid4().hex}.tmp.wav'
+    try:
+        get_engine().synthesize(sentence, tmp_file, speaker=speaker)
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return output_file
+
+def get_pool(workers=TTS_WORKERS):
+    """
+    Get the shared pool of synthesis processes, each one holding its own loaded model.
+
+    Args:
+        workers (int): Number of synthesis processes.
+
+    Returns:
+        ProcessPoolExecutor: The shared pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_pool_worker,
+                                        initargs=(threads,))
+        return _pool
+
+def join_wavs(wav_files, output_file, pause=0.2):
+    """
+    Concatenate wav files sharing the same format without re-encoding them.
+
+    Args:
+        wav_files (list): Paths of the wav files to join.
+        output_file (str): Path of the joined wav file.
+        pause (float): Seconds of silence inserted between files.
+
+    Returns:
+        list: The (start, end) time of every file in the joined wav, in seconds.
+    """
+    timings = []
+    position = 0
+    with wave.open(output_file, 'wb') as output:
+        params = None
+        for i, wav_file in enumerate(wav_files):
+            with wave.open(wav_file, 'rb') as source:
+                if params is None:
+                    params = source.getparams()
+                    output.setparams(params)
+                    silence = b'\x00' * int(params.framerate * pause) * params.sampwidth * params.nchannels
+                elif source.getparams()[:3] != params[:3]:
+                    raise ValueError(f'{wav_file} does not match the format of {wav_files[0]}')
+                if i > 0:
+                    output.writeframes(silence)
+                    position += int(params.framerate * pause)
+                frames = source.getnframes()
+                output.writeframes(source.readframes(frames))
+                timings.append((position / params.framerate, (position + frames) / params.framerate))
+                position += frames
+    return timings
+
+def synthesize_text(txt, output_file, speaker=DEFAULT_SPEAKER, workers=TTS_WORKERS):
+    """
+    Convert text to speech sentence by sentence, reusing cached sentences.
+
+    Sentences missing from the cache are synthesized in parallel in the process
+    pool (or with the in-process engine when workers is 1), then every sentence
+    is joined into the output file.
+
+    Args:
+        txt (str): The text to convert.
+        output_file (str): The path to save the speech.
+        speaker (str, optional): Speaker identity. Defaults to 'p330'.
+        workers (int): Number of synthesis processes.
+
+    Returns:
+        list: The (start, end, sentence) segments of the speech, times in seconds.
+    """
+    speaker = resolve_speaker(speaker)
+    sentences = split_sentences(txt)
+    if not sentences:
+        raise ValueError('There is no text to convert to speech')
+
+    paths = [cache_path(sentence, speaker) for sentence in sentences]
+    missing = {}
+    for sentence, path in zip(sentences, paths):
+        if not os.path.exists(path):
+            missing[path] = sentence
+    logger.info(f'{len(sentences) - len(missing)}/{len(sentences)} sentences found in TTS cache')
+
+    for path in missing:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if workers > 1 and len(missing) > 1:
+        pool = get_pool(workers)
+        futures = [pool.submit(_synthesize_sentence, sentence, speaker, path) for path, sentence in missing.items()]
+        for future in futures:
+            future.result()
+    else:
+        for path, sentence in missing.items():
+            _synthesize_sentence(sentence, speaker, path)
+
+    timings = join_wavs(paths, output_file)
+    return [(start, end, sentence) for (start, end), sentence in zip(timings, sentences)]
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            outputs = [synthesize_text(job['text'], job['output_file'], job.get('speaker', DEFAULT_SPEAKER))
+                       for job in request['jobs']]
+            response = {'outputs': outputs}
+        except Exception as e:
+            logger.error(f'Unable to synthesize batch: {e}')
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+def serve(socket_path=TTS_SOCKET):
+    """
+    Run a local text to speech worker listening on a Unix socket.
+
+    Each connection sends one JSON line {"jobs": [...]} and receives one JSON
+    line {"outputs": [...]}, holding the speech segments of every job, or
+    {"error": "..."} back.
+
+    Args:
+        socket_path (str): Path of the Unix socket to listen on.
+
+    Returns:
+        None
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    get_engine()
+    with socketserver.ThreadingUnixStreamServer(socket_path, _WorkerHandler) as server:
+        logger.info(f'TTS worker listening on {socket_path}')
+        server.serve_forever()
+
+def synthesize_remote(jobs, socket_path=TTS_SOCKET):
+    """
+    Send a batch of jobs to a running text to speech worker.
+
+    Args:
+        jobs (list): List of dicts with 'text', 'output_file' and optional 'speaker' keys.
+        socket_path (str): Path of the worker Unix socket.
+
+    Raises:
+        ValueError: If the worker fails to synthesize the batch.
+
+    Returns:
+        list: The (start, end, sentence) segments of every job.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps({'jobs': jobs}) + '\n').encode())
+        with client.makefile('r') as stream:
+            response = json.loads(stream.readline())
+
+    if 'error' in response:
+        raise ValueError('TTS worker error: ' + response['error'])
+    return response['outputs']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a persistent text to speech worker.")
+    parser.add_argument("-s", "--socket", dest="socket_path", default=TTS_SOCKET or 'tts.sock', help="Unix socket path")
+    args = parser.parse_args()
+    serve(args.socket_path)
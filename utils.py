@@ -1,11 +1,16 @@
 import subprocess
 import os
-import torch
-import random
-from TTS.api import TTS
-from vosk import Model, KaldiRecognizer, SetLogLevel
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import tts
+import asr
+import subtitles
+from profiles import get_profile
+from probe import probe, probe_many
 from log import logger
 
+CONCAT_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
 
 def create_folder(folder_path):
     """
@@ -20,21 +25,28 @@ def create_folder(folder_path):
         os.makedirs(folder_path)
         logger.info(f'Folder {folder_path} was created')
 
-def clean_up():
+def clean_up(workspace):
     """
-    Remove temporary and cache folders.
+    Remove the temporary files of a job.
+
+    Only the given workspace is removed, so other jobs running on the same
+    machine are not affected.
 
+    Args:
+        workspace (Workspace): The workspace of the job.
     Returns:
         None
     """
-    command = ['rm', '-rf', 'tmp', '__pycache__']
-    stream = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _, _ = stream.communicate()
+    workspace.clean_up()
 
 def text_to_speech(txt, output_file, speaker='p330'):
     """
     Convert text to speech and save it to a file.
 
+    The text is synthesized sentence by sentence through the sentence cache and
+    the model is kept loaded between calls. When TTS_SOCKET is set the job is
+    sent to the persistent worker listening on that socket instead.
+
     Args:
         txt (str): The text to convert.
         output_file (str): The path to save the speech.
@@ -43,43 +55,23 @@ def text_to_speech(txt, output_file, speaker='p330'):
         None
     """
     try:
-        # Available speakers
-        speakers = ['ED', 'p225', 'p226', 'p227', 'p228', 'p229',
-                    'p230', 'p231', 'p232', 'p233', 'p234', 'p236',
-                    'p237', 'p238', 'p239', 'p240', 'p241', 'p243',
-                    'p244', 'p245', 'p246', 'p247', 'p248', 'p249',
-                    'p250', 'p251', 'p252', 'p253', 'p254', 'p255',
-                    'p256', 'p257', 'p258', 'p259', 'p260', 'p261',
-                    'p262', 'p263', 'p264', 'p265', 'p266', 'p267',
-                    'p268', 'p269', 'p270', 'p271', 'p272', 'p273',
-                    'p274', 'p275', 'p276', 'p277', 'p278', 'p279',
-                    'p280', 'p281', 'p282', 'p283', 'p284', 'p285',
-                    'p286', 'p287', 'p288', 'p292', 'p293', 'p294',
-                    'p295', 'p297', 'p298', 'p299', 'p300', 'p301',
-                    'p302', 'p303', 'p304', 'p305', 'p306', 'p307',
-                    'p308', 'p310', 'p311', 'p312', 'p313', 'p314',
-                    'p316', 'p317', 'p318', 'p323', 'p326', 'p329',
-                    'p330', 'p333', 'p334', 'p335', 'p336', 'p339',
-                    'p340', 'p341', 'p343', 'p345', 'p347', 'p351',
-                    'p360', 'p361', 'p362', 'p363', 'p364', 'p374',
-                    'p376']
-
-        if not speaker:
-            speaker = random.choice(speakers)
-
-        if speaker in speakers:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-
-            tts = TTS(model_name="tts_models/en/vctk/vits", progress_bar=False).to(device)
-            logger.info('Converting text to speech, please wait...')
-            tts.tts_to_file(txt, file_path=output_file, speaker=speaker)
+        speaker = tts.resolve_speaker(speaker)
+        logger.info('Converting text to speech, please wait...')
+
+        if tts.TTS_SOCKET:
+            segments = tts.synthesize_remote([{'text': txt, 'output_file': os.path.abspath(output_file), 'speaker': speaker}])[0]
+        else:
+            segments = tts.synthesize_text(txt, output_file, speaker=speaker)
+
+        # keep the sentence timings so subtitles don't need speech recognition
+        subtitles.write_timings(segments, output_file)
 
     except Exception as e:
         raise e
 
 def get_duration(file_path):
     """
-    Get the duration of a media file using ffprobe.
+    Get the duration of a media file.
 
     Parameters:
         file_path (str): The path to the input media file.
@@ -88,49 +80,150 @@ def get_duration(file_path):
         float: The duration of the media file in seconds.
 
     Raises:
-        subprocess.CalledProcessError: If ffprobe command fails.
-        ValueError: If the duration cannot be converted to a float.
+        ValueError: If the file cannot be probed.
     """
-    try:
-        command = [
-            "ffprobe",
-            "-i",
-            file_path,
-            "-show_entries",
-            "format=duration",
-            "-v",
-            "quiet",
-            "-of",
-            "csv=p=0",
-        ]
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT)
-        return float(result.strip())
-    except subprocess.CalledProcessError as e:
-        raise e
-    except Exception as e:
-        raise ValueError("Error - Unable to get duration")
+    return probe(file_path).duration
+
+def normalize_video(file_path, output_file, reference, profile=None):
+    """
+    Re-encode a video so its stream parameters match a reference stream.
+
+    Args:
+        file_path (str): Path to the input video file.
+        output_file (str): Path to the normalized video file.
+        reference (MediaInfo): Probed parameters of the reference video.
+        profile (str or RenderProfile, optional): Render profile giving the encoder preset and quality.
+
+    Raises:
+        ValueError: If ffmpeg fails to normalize the video.
+
+    Returns:
+        str: Path to the normalized video.
+    """
+    profile = get_profile(profile)
+    width, height = reference.width, reference.height
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", file_path,
+        "-map", "0:v:0",
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1",
+        "-r", reference.r_frame_rate,
+        "-pix_fmt", reference.pix_fmt,
+        "-c:v", CONCAT_ENCODERS.get(reference.codec_name, "libx264"),
+        "-preset", profile.preset,
+        "-crf", str(profile.crf),
+        "-video_track_timescale", reference.time_base.split("/")[1],
+        output_file,
+    ]
+    stream = subprocess.Popen(command, stderr=subprocess.PIPE, text=True)
+    _, stderr = stream.communicate()
+    if stream.returncode != 0:
+        raise ValueError(f'Unable to normalize {file_path}: {stderr}')
+    return output_file
+
+def normalize_videos(video_paths, work_folder, profile=None):
+    """
+    Make videos joinable without re-encoding.
+
+    The videos are probed in one batch. Those whose codec, resolution, pixel format and
+    timebase differ from the most common ones are normalized in parallel, and the
+    rest are used as they are.
+
+    Args:
+        video_paths (list): List of paths to input video files.
+        work_folder (str): Folder for the normalized videos.
+        profile (str or RenderProfile, optional): Render profile giving the encoder preset and quality.
+
+    Raises:
+        ValueError: If there are no videos.
+
+    Returns:
+        list: Paths of the videos to join, in the same order.
+    """
+    if not video_paths:
+        raise ValueError('At least one video is required to normalize, no footage was downloaded')
+    create_folder(work_folder)
+    streams = probe_many(video_paths)
+    signatures = [stream.concat_signature for stream in streams]
+    reference_signature = Counter(signatures).most_common(1)[0][0]
+    reference = streams[signatures.index(reference_signature)]
+
+    # clips in a codec we cannot encode to are all normalized to h264
+    normalize_all = reference.codec_name not in CONCAT_ENCODERS
+    mismatched = [i for i, signature in enumerate(signatures) if normalize_all or signature != reference_signature]
+    paths = list(video_paths)
+
+    if mismatched:
+        logger.info(f'Normalizing {len(mismatched)} of {len(video_paths)} videos before concatenation')
+        with ThreadPoolExecutor(max_workers=min(len(mismatched), os.cpu_count() or 1)) as executor:
+            futures = {i: executor.submit(normalize_video, video_paths[i],
+                                          os.path.join(work_folder, f'normalized-{i}.mp4'), reference, profile)
+                       for i in mismatched}
+            for i, future in futures.items():
+                paths[i] = future.result()
+    return paths
+
+def write_concat_list(video_paths, list_file):
+    """
+    Write a concat demuxer list file.
 
-def merge_videos(video_paths, output_file="finish.mp4"):
+    Args:
+        video_paths (list): List of paths to the videos to join.
+        list_file (str): Path to the list file.
+
+    Returns:
+        str: Path to the list file.
+    """
+    with open(list_file, 'w') as f:
+        for path in video_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    return list_file
+
+def prepare_concat(video_paths, work_folder, profile=None):
+    """
+    Write a concat demuxer list for videos that can be joined without re-encoding.
+
+    Args:
+        video_paths (list): List of paths to input video files.
+        work_folder (str): Folder for the concat list and the normalized videos.
+        profile (str or RenderProfile, optional): Render profile giving the encoder preset and quality.
+
+    Returns:
+        tuple: Path to the concat list file, and the paths it lists, normalized ones included.
+    """
+    paths = normalize_videos(video_paths, work_folder, profile=profile)
+    return write_concat_list(paths, os.path.join(work_folder, 'concat.txt')), paths
+
+def merge_videos(video_paths, output_file="finish.mp4", work_folder=None, profile=None):
     """
     Merge multiple videos into a single video file using ffmpeg.
 
+    The videos are joined with the concat demuxer and stream copied, so only the
+    videos whose stream parameters differ from the others are re-encoded. Profiles
+    with a lower resolution, like preview, downscale here so every later step works
+    on the smaller video.
+
     Args:
         video_paths (list): List of paths to input video files.
         output_file (str): Output file name for the merged video.
+        work_folder (str, optional): Folder for intermediate files. Defaults to the output folder.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
 
     Returns:
         None
     """
     try:
         logger.info("Merging videos, please wait...")
-        command = ["ffmpeg"]
-        for path in video_paths:
-            command.extend(["-i", path])
-
-        filter_complex = "".join([f"[{i}:v]" for i in range(len(video_paths))])
-        filter_complex += f"concat=n={len(video_paths)}:v=1:a=0[outv]"
-        command.extend(["-filter_complex", filter_complex])
-        command.extend(["-map", "[outv]", "-r", "30", output_file])
+        profile = get_profile(profile)
+        work_folder = work_folder or os.path.join(os.path.dirname(output_file) or '.', 'concat')
+        list_file, _ = prepare_concat(video_paths, work_folder, profile=profile)
+        if profile.height:
+            codec = ["-vf", f"scale=-2:'min({profile.height},ih)'", "-r", profile.fps] + profile.encoder_args()
+        else:
+            codec = ["-c", "copy"]
+        command = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file,
+                   "-map", "0:v"] + codec + [output_file]
         stream = subprocess.Popen(command, text=True)
         stdout, stderr = stream.communicate()
         if stream.returncode == 0:
@@ -139,20 +232,22 @@ def merge_videos(video_paths, output_file="finish.mp4"):
         logger.error('Unable to merge videos')
         raise e
 
-def audio_into_video(video, audio, output_file):
+def audio_into_video(video, audio, output_file, profile=None):
     """
     Merge audio into a video file.
 
     Args:
         video (str): Path to the input video file.
         audio (str): Path to the input audio file.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
 
     Returns:
         None
     """
     try:
         logger.info("Merging audio into video")
-        duration_audio = get_duration(audio)
+        profile = get_profile(profile)
+        duration_audio = probe(audio).duration
         min_duration = duration_audio + 2
 
         command = [
@@ -162,8 +257,9 @@ def audio_into_video(video, audio, output_file):
             "-filter_complex", f"[0:v]trim=0:{min_duration},setpts=PTS-STARTPTS[v];[1:a]atrim=0:{min_duration},asetpts=PTS-STARTPTS[a]",
             "-map", "[v]",
             "-map", "[a]",
+            *profile.encoder_args(),
             "-movflags", "+faststart",
-            "-r", "30",
+            "-r", profile.fps,
             output_file,
         ]
 
@@ -182,7 +278,11 @@ def audio_into_video(video, audio, output_file):
 
 def generate_srt(audio_file, output_file):
     """
-    Generate SRT subtitles from an audio file using Vosk.
+    Generate SRT subtitles for an audio file.
+
+    When the audio was produced by text_to_speech the cues are built from the
+    sentence timings captured during synthesis. Otherwise the speech is recognized
+    with Vosk, see asr.Recognizer.
 
     Args:
         audio_file (str): Path to the audio file.
@@ -192,44 +292,38 @@ def generate_srt(audio_file, output_file):
         None
     """
     try:
-        SAMPLE_RATE = 16000
-
-        SetLogLevel(-1)
-
-        model = Model(lang="en-us")
-        rec = KaldiRecognizer(model, SAMPLE_RATE)
-        rec.SetWords(True)
-        logger.info('Generating srt subtitles files')
-        with subprocess.Popen(["ffmpeg", "-loglevel", "quiet", "-i",
-                                   audio_file,
-                                   "-ar", str(SAMPLE_RATE), "-ac", "1", "-f", "s16le", "-"],
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout as stream:
-
-            with open(output_file, "w") as file:
-                file.write(rec.SrtResult(stream))
-            logger.info('SRT file created successfully')
+        segments = subtitles.read_timings(audio_file)
+        if segments:
+            logger.info('Generating srt subtitles files from speech timings')
+            subtitles.write_srt(subtitles.cues_from_segments(segments), output_file)
+        else:
+            asr.get_recognizer().generate_srt(audio_file, output_file)
     except Exception as e:
         raise e
 
-def embed_srt_into_video(video_input, srt_file_path, output_file, fps='30'):
+def embed_srt_into_video(video_input, srt_file_path, output_file, fps=None, profile=None):
     """
     Embed SRT subtitles into a video file.
 
     Args:
         video_input (str): Path to the input video file.
         output_file (str): Path to the output video file with subtitles.
+        fps (str, optional): Frames per second of the output. Defaults to the frame rate of the profile.
+        profile (str or RenderProfile, optional): Render profile. Defaults to RENDER_PROFILE.
     Returns:
         None
     """
     try:
         logger.info("Adding subtitles to videos")
+        profile = get_profile(profile)
         command = [
             "ffmpeg",
             "-i",
             video_input,
             "-vf",
             f"subtitles={srt_file_path}",
-            "-r", fps,
+            *profile.encoder_args(),
+            "-r", fps or profile.fps,
             output_file
         ]
         stream = subprocess.Popen(
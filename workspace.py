@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+from log import logger
+from metrics import JobMetrics
+from dotenv import load_dotenv, find_dotenv
+
+
+load_dotenv(find_dotenv())
+
+TMP_FOLDER = os.environ.get('TMP_FOLDER', 'tmp/')
+RAM_FOLDER = os.environ.get('RAM_FOLDER', '/dev/shm')
+WORKSPACE_RAM = os.environ.get('WORKSPACE_RAM', '').lower() in ('1', 'true', 'yes')
+
+
+class Workspace:
+    """
+    Private folder holding every intermediate file of a single job.
+
+    Each job gets its own workspace so several shorts can run at the same time on
+    one machine without overwriting each other's files, and cleaning up a job only
+    removes its own workspace.
+    """
+
+    def __init__(self, root=None, tmp_folder=TMP_FOLDER, ram=WORKSPACE_RAM, metrics=None):
+        """
+        Create the workspace folder.
+
+        Args:
+            root (str, optional): Folder to use as workspace. A new unique folder is created when omitted.
+            tmp_folder (str): Parent folder of new workspaces.
+            ram (bool): Create new workspaces on the RAM disk (RAM_FOLDER) when it is available.
+            metrics (JobMetrics, optional): Measurements of the job, a new one is used when omitted.
+        """
+        if root is None:
+            parent = RAM_FOLDER if ram and os.path.isdir(RAM_FOLDER) else tmp_folder
+            os.makedirs(parent, exist_ok=True)
+            root = tempfile.mkdtemp(prefix='job-', dir=parent)
+        else:
+            os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.metrics = metrics or JobMetrics()
+        os.makedirs(self.pexels_folder, exist_ok=True)
+
+    def path(self, name):
+        """
+        Get the path of a file inside the workspace.
+
+        Args:
+            name (str): Name of the file.
+
+        Returns:
+            str: The path of the file.
+        """
+        return os.path.join(self.root, name)
+
+    @property
+    def audio_file(self):
+        return self.path('t2s.wav')
+
+    @property
+    def srt_file(self):
+        return self.path('sub.srt')
+
+    @property
+    def pexels_folder(self):
+        return self.path('pexels/')
+
+    def clean_up(self):
+        """
+        Remove the workspace and everything in it.
+
+        Returns:
+            None
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
+        logger.info(f'Workspace {self.root} was removed')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.clean_up()